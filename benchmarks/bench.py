@@ -0,0 +1,400 @@
+"""
+Name: bench
+Author: Chinedu A. Anene, Phd
+
+Benchmark every stage of the pipeline on deterministic synthetic data.
+Each stage runs in a fresh process so its peak RSS is its own.
+
+Usage:
+    python benchmarks/bench.py --out bench.json
+    python benchmarks/bench.py --out new.json --compare bench.json
+    python benchmarks/bench.py --check
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing as mp
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STAGES = ["slide_to_image", "segmentation", "tile_extraction", "scoring", "scoring_single", "scoring_reference",
+          "gray_filter", "tiling", "normalise_macenko", "normalise_reinhard", "normalise_vahadane"]
+
+# Largest concentration difference allowed between the NumPy solver and spams.lasso
+CONCENTRATION_TOLERANCE = 1e-4
+
+
+def synthetic_he(h, w, seed=0):
+    """
+    Make a deterministic H&E-like RGB image: bright glass with purple and pink tissue blobs.
+
+    Args:
+        h: Height of the image.
+        w: Width of the image.
+        seed: Random seed.
+    Returns:
+        RGB image as a (h, w, 3) uint8 NumPy array.
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((h, w, 3), 236, dtype=np.uint8)
+
+    # Tissue blobs on a coarse grid, upsampled
+    g = 16
+    yy, xx = np.mgrid[0:h:g, 0:w:g]
+    tissue = np.zeros(yy.shape, dtype=bool)
+    nuclei = np.zeros(yy.shape, dtype=bool)
+    for _ in range(8):
+        cy, cx = rng.uniform(0, h), rng.uniform(0, w)
+        r = rng.uniform(0.08, 0.25) * min(h, w)
+        tissue |= (yy - cy) ** 2 + (xx - cx) ** 2 < r * r
+    nuclei = tissue & (rng.random(yy.shape) < 0.35)
+
+    tissue = np.kron(tissue, np.ones((g, g), dtype=bool))[:h, :w]
+    nuclei = np.kron(nuclei, np.ones((g, g), dtype=bool))[:h, :w]
+
+    noise = rng.integers(0, 40, (h, w, 1), dtype=np.uint8)
+    pink = np.concatenate([200 + noise // 2, 110 + noise, 170 + noise // 2], axis=2)
+    purple = np.concatenate([110 + noise, 60 + noise, 150 + noise], axis=2)
+    img[tissue] = pink[tissue]
+    img[nuclei] = purple[nuclei]
+    return img
+
+
+def synthetic_slide(path, size=8192, seed=0, tile=256, levels=4):
+    """
+    Write a deterministic pyramidal tiled TIFF that OpenSlide opens as a generic tiled TIFF.
+    Needs the tifffile package.
+
+    Args:
+        path: File to write.
+        size: Width and height of level 0.
+        seed: Random seed.
+        tile: TIFF tile size.
+        levels: Number of pyramid levels, each half the size of the previous one.
+    """
+    try:
+        import tifffile
+    except ImportError:
+        sys.exit("ERROR: The benchmark needs tifffile to write synthetic slides (pip install tifffile)")
+
+    img = synthetic_he(size, size, seed)
+    with tifffile.TiffWriter(path) as tw:
+        for le in range(levels):
+            tw.write(img, tile=(tile, tile), photometric="rgb", compression="zlib",
+                     subfiletype=0 if le == 0 else 1)
+            img = img[::2, ::2]
+    return
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def count_files(path, ext=".jpg"):
+    return sum(f.endswith(ext) for _, _, files in os.walk(path) for f in files)
+
+
+def stage_slide_to_image(work):
+    import openslide as op
+    from iwspp.flows import slide
+
+    sl = op.open_slide(os.path.join(work, "data", "bench.tif"))
+    s = 32
+    le = sl.get_best_level_for_downsample(s)
+    size = (sl.dimensions[0] // s, sl.dimensions[1] // s)
+
+    t = time.perf_counter()
+    slide.read_scaled(sl, le, size)
+    elapsed = time.perf_counter() - t
+
+    w, h = sl.level_dimensions[le]
+    return elapsed, 1, w * h * 3
+
+
+def stage_segmentation(work):
+    from iwspp.flows import segment
+
+    x = os.path.join(work, "data", "bench.tif")
+    t = time.perf_counter()
+    segment.segment_slide(x, os.path.join(work, "bench" + segment.MASK_SUFFIX), s=4, block=1024)
+    elapsed = time.perf_counter() - t
+
+    tm = segment.TissueMask(os.path.join(work, "bench" + segment.MASK_SUFFIX))
+    return elapsed, int(tm.state.size), tm.shape[0] * tm.shape[1] * 3
+
+
+def stage_tile_extraction(work):
+    from iwspp.flows import slide
+
+    np.random.seed(0)
+    sl = slide.Slide(os.path.join(work, "data", "bench.tif"))
+
+    t = time.perf_counter()
+    sl.fit(s=32, t=256, mx=20, threshold=80, sample=1, n=200)
+    elapsed = time.perf_counter() - t
+
+    n = count_files(os.path.join(work, "data", "converted", "bench"))
+    return elapsed, n, n * 256 * 256 * 3
+
+
+def tile_stack(n=256, t=256):
+    img = synthetic_he(2048, 2048, seed=1)
+    tiles = [img[r:r + t, c:c + t] for r in range(0, 2048, t) for c in range(0, 2048, t)]
+    return np.stack([tiles[i % len(tiles)] for i in range(n)])
+
+
+def stage_scoring(work):
+    from iwspp.flows import filter, stain
+
+    stack = tile_stack()
+    tps = filter.tissue_fraction(stack) * 100
+
+    t = time.perf_counter()
+    for k in range(0, len(stack), stain.SCORE_CHUNK):
+        stain.score_tiles(stack[k:k + stain.SCORE_CHUNK], tps[k:k + stain.SCORE_CHUNK])
+    elapsed = time.perf_counter() - t
+    return elapsed, len(stack), stack.nbytes
+
+
+def stage_scoring_single(work):
+    from iwspp.flows import filter, stain
+
+    stack = tile_stack(n=64)
+    tps = filter.tissue_fraction(stack) * 100
+
+    t = time.perf_counter()
+    for k in range(len(stack)):
+        stain.score_tile(stack[k], tps[k])
+    elapsed = time.perf_counter() - t
+    return elapsed, len(stack), stack.nbytes
+
+
+def stage_scoring_reference(work):
+    from iwspp.flows import filter, stain
+
+    stack = tile_stack(n=16)
+    tps = filter.tissue_fraction(stack) * 100
+
+    t = time.perf_counter()
+    for k in range(len(stack)):
+        stain.score_tile_reference(stack[k], tps[k])
+    elapsed = time.perf_counter() - t
+    return elapsed, len(stack), stack.nbytes
+
+
+def stage_gray_filter(work):
+    from iwspp.flows import filter
+
+    stack = tile_stack()
+
+    t = time.perf_counter()
+    for k in range(len(stack)):
+        filter.tissue_fraction(stack[k])
+    elapsed = time.perf_counter() - t
+    return elapsed, len(stack), stack.nbytes
+
+
+def stage_tiling(work):
+    from iwspp.flows import tiles
+
+    out = os.path.join(work, "tiles")
+    t = time.perf_counter()
+    tiles.Tile(x=os.path.join(work, "bench.png"), o=out, t=50).fit()
+    elapsed = time.perf_counter() - t
+
+    img = Image.open(os.path.join(work, "bench.png"))
+    return elapsed, count_files(out), img.size[0] * img.size[1] * 3
+
+
+def normalise(work, module):
+    import importlib
+    from iwspp.flows import util
+
+    norm = importlib.import_module("iwspp.Normalize." + module).Normalizer()
+    target = util.read_image(os.path.join(work, "reference.png"))
+    source = util.read_image(os.path.join(work, "source.png"))
+
+    t = time.perf_counter()
+    norm.fit(target)
+    norm.transform(source)
+    elapsed = time.perf_counter() - t
+    return elapsed, 1, source.nbytes
+
+
+def stage_normalise_macenko(work):
+    return normalise(work, "Macenko")
+
+
+def stage_normalise_reinhard(work):
+    return normalise(work, "Reinhard")
+
+
+def stage_normalise_vahadane(work):
+    return normalise(work, "Vahadane")
+
+
+def check_scoring():
+    """
+    Check the single pass scoring against the float64 reference on the benchmark tiles.
+
+    Returns:
+        Largest score difference, or raises AssertionError above stain.SCORE_TOLERANCE.
+    """
+    from iwspp.flows import filter, stain
+
+    stack = tile_stack(n=64)
+    tps = filter.tissue_fraction(stack) * 100
+    new = stain.score_tiles(stack, tps)
+    ref = np.array([stain.score_tile_reference(stack[k], tps[k]) for k in range(len(stack))]).T
+
+    diff = float(np.abs(new[0] - ref[0]).max())
+    assert diff <= stain.SCORE_TOLERANCE, "score differs by {} from the reference".format(diff)
+    assert np.array_equal(new[2], ref[2]) and np.array_equal(new[3], ref[3]), "factors differ from the reference"
+    single = stain.score_tile(stack[0], tps[0])
+    assert np.allclose(single, [x[0] for x in new]), "score_tile differs from score_tiles"
+    return diff
+
+
+def check_concentrations(tolerance=CONCENTRATION_TOLERANCE):
+    """
+    Check the NumPy active-set concentration solver against spams.lasso.
+
+    Returns:
+        Largest concentration difference, or raises AssertionError above tolerance.
+    """
+    from iwspp.flows import util
+    from iwspp.Normalize import Macenko
+
+    diff = 0.0
+    for seed in range(3):
+        img = util.standardize_brightness(synthetic_he(512, 512, seed=seed))
+        stains = Macenko.get_stain_matrix(img.copy())
+        ref = util.get_concentrations(img.copy(), stains, method="spams")
+        new = util.get_concentrations(img.copy(), stains, method="active_set")
+        diff = max(diff, float(np.abs(new - ref).max()))
+    assert diff <= tolerance, "concentrations differ by {} from spams".format(diff)
+    return diff
+
+
+def run_stage(name, work, conn):
+    """
+    Run one stage in this process and send back its measurements.
+    """
+    try:
+        os.chdir(work)
+        base = rss_mb()
+        elapsed, units, nbytes = globals()["stage_" + name](work)
+        conn.send({"seconds": elapsed, "units": units, "mb": nbytes / 1e6,
+                   "units_per_s": units / elapsed if elapsed else None,
+                   "mb_per_s": nbytes / 1e6 / elapsed if elapsed else None,
+                   "peak_rss_mb": rss_mb(), "start_rss_mb": base})
+
+    except BaseException as err:
+        conn.send({"error": repr(err)})
+    conn.close()
+    return
+
+
+def prepare(work, size):
+    """
+    Write the synthetic slide and images used by the stages.
+    """
+    os.makedirs(os.path.join(work, "data"))
+    synthetic_slide(os.path.join(work, "data", "bench.tif"), size=size)
+    Image.fromarray(synthetic_he(2048, 2048, seed=2)).save(os.path.join(work, "bench.png"))
+    Image.fromarray(synthetic_he(512, 512, seed=3)).save(os.path.join(work, "reference.png"))
+    Image.fromarray(synthetic_he(1024, 1024, seed=4)).save(os.path.join(work, "source.png"))
+    return
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(new, old):
+    """
+    Print the speed of each stage against an earlier result file.
+    """
+    print("%-22s %12s %12s %8s" % ("Stage", "old s", "new s", "speedup"))
+    for name, res in new["stages"].items():
+        prev = old["stages"].get(name, {})
+        if "seconds" in res and "seconds" in prev:
+            print("%-22s %12.4f %12.4f %7.2fx" % (name, prev["seconds"], res["seconds"],
+                                                 prev["seconds"] / res["seconds"]))
+        else:
+            fmt = lambda r: "%.4f" % r["seconds"] if "seconds" in r else "-"
+            print("%-22s %12s %12s" % (name, fmt(prev), fmt(res)))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the iwspp pipeline on synthetic data.")
+    parser.add_argument("--out", default="bench.json", help="JSON file for the results")
+    parser.add_argument("--size", default=8192, type=int, help="Width and height of the synthetic slide")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages to run")
+    parser.add_argument("--compare", default=None, help="Earlier result file to compare with")
+    parser.add_argument("--check", action="store_true", help="Only check the fast paths against their references")
+    args = parser.parse_args()
+
+    if args.check:
+        from iwspp.flows import stain
+        print("scoring: max score difference %.2e (tolerance %.0e)" % (check_scoring(), stain.SCORE_TOLERANCE))
+        print("concentrations: max difference to spams %.2e (tolerance %.0e)" % (check_concentrations(),
+                                                                                CONCENTRATION_TOLERANCE))
+        return
+
+    work = tempfile.mkdtemp(prefix="iwspp-bench-")
+    ctx = mp.get_context("spawn")
+    result = {"commit": git_commit(), "python": platform.python_version(),
+              "numpy": np.__version__, "machine": platform.platform(),
+              "cpus": os.cpu_count(), "size": args.size, "stages": {}}
+
+    try:
+        # Peak RSS survives exec, so the data is made in a child to keep this process small
+        proc = ctx.Process(target=prepare, args=(work, args.size))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            sys.exit("ERROR: Could not write the synthetic data")
+        for name in args.stages.split(","):
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=run_stage, args=(name, work, send))
+            proc.start()
+            res = recv.recv() if recv.poll(3600) else {"error": "timeout"}
+            proc.join()
+            result["stages"][name] = res
+
+            if "error" in res:
+                print("%-22s ERROR %s" % (name, res["error"]))
+            else:
+                print("%-22s %9.4f s %10.1f units/s %9.1f MB/s %8.1f MB peak RSS" % (
+                    name, res["seconds"], res["units_per_s"], res["mb_per_s"], res["peak_rss_mb"]))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    with open(args.out, "w") as fh:
+        json.dump(result, fh, indent=2)
+    print("Results in {}".format(args.out))
+
+    if args.compare is not None:
+        with open(args.compare) as fh:
+            compare(result, json.load(fh))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -7,21 +7,34 @@ from __future__ import division
 import numpy as np
 import os
 import iwspp.flows.util as ut
+import iwspp.flows.filter as ft
+import iwspp.flows.metrics as mt
+from iwspp.flows.tilename import TILE_NAME, slide_key
 
+# Tiles sampled per slide to estimate its stain matrix
+SOURCE_TILES = 16
 
-def get_stain_matrix(x, beta=0.15, alpha=1):
+
+def get_stain_matrix(x, beta=0.15, alpha=1, n=ut.STAIN_PIXELS, seed=0):
     """
     Get stain matrix (2x3)
+    The covariance is streamed over the tissue pixels and the angle percentiles
+    come from a seeded sample of at most n of them (see util.stain_sample).
 
     Args:
         x: Image to process
         beta: first threshold
         alpha: Second threshold
+        n: Most pixels in the sample
+        seed: Seed of the sample
+    Raises:
+        ValueError: When fewer than two pixels pass beta, as on blank tiles.
     """
 
-    od = ut.convert_rgb_od(x, t="od").reshape((-1, 3))
-    od = (od[(od > beta).any(axis=1), :])
-    _, vv = np.linalg.eigh(np.cov(od, rowvar=False))
+    cov, od = ut.stain_sample(x, lambda o, rgb: (o > beta).any(axis=1), n=n, seed=seed)
+    if cov is None:
+        raise ValueError("no tissue pixels to estimate stains from")
+    _, vv = np.linalg.eigh(cov)
     vv = vv[:, [2, 1]]
     if vv[0, 0] < 0: vv[:, 0] *= -1
     if vv[0, 1] < 0: vv[:, 1] *= -1
@@ -42,25 +55,103 @@ class Normalizer(object):
     A stain normalization object
     """
 
-    def __init__(self):
+    def __init__(self, method="active_set"):
+        """
+        Normalizer class.
+
+        Parameters:
+            method: Concentration solver, "active_set" (NumPy) or "spams" (see util.get_concentrations).
+        """
+        self.method = method
         self.stain_matrix_target = None
-        self.target_concentrations = None
+        self.max_c_target = None
+        self.sources = {}
 
     def fit(self, target):
         target = ut.standardize_brightness(target)
         self.stain_matrix_target = get_stain_matrix(target)
-        self.target_concentrations = ut.get_concentrations(target, self.stain_matrix_target)
+        target_concentrations = ut.get_concentrations(target, self.stain_matrix_target, method=self.method)
+        self.max_c_target = np.percentile(target_concentrations, 99, axis=0).reshape((1, 2))
+
+    def save(self, path):
+        """
+        Save the fitted target, see load().
+
+        Args:
+            path: File to write (.npz).
+        """
+        ut.save_normalizer(path, "macenko", method=self.method, stain_matrix_target=self.stain_matrix_target,
+                           max_c_target=self.max_c_target)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Get a fitted Normalizer from a file written by save().
+
+        Args:
+            path: File to read.
+        """
+        state = ut.load_normalizer(path, "macenko")
+        norm = cls(method=str(state["method"]))
+        norm.stain_matrix_target = state["stain_matrix_target"]
+        norm.max_c_target = state["max_c_target"]
+        return norm
 
     def target_stains(self):
         return ut.convert_rgb_od(self.stain_matrix_target, t="rgb")
 
-    def transform(self, x):
-        x = ut.standardize_brightness(x)
-        stain_matrix_source = get_stain_matrix(x)
-        source_concentrations = ut.get_concentrations(x, stain_matrix_source)
+    def fit_source(self, x, key=None, n=SOURCE_TILES, seed=0):
+        """
+        Estimate the source stain matrix and 99th percentile concentrations once
+        for a slide, and cache them under key for transform().
+
+        Args:
+            x: Scaled image of the slide, or list of its tiles. Tiles are sampled
+               with probability proportional to their tissue fraction.
+            key: Slide the estimate is cached under, see slide_key().
+            n: Number of tiles to sample.
+            seed: Seed of the sample.
+        Returns:
+            Tuple of stain matrix (2x3) and 99th percentile concentrations (1x2).
+        """
+        tiles = [x] if isinstance(x, np.ndarray) and x.ndim == 3 else list(x)
+        if len(tiles) > n:
+            w = np.array([ft.tissue_fraction(t) for t in tiles]) + 1e-6
+            pick = np.random.RandomState(seed).choice(len(tiles), n, replace=False, p=w / w.sum())
+            tiles = [tiles[i] for i in sorted(pick)]
+
+        # Every tile is standardized on its own, as in transform()
+        px = np.concatenate([ut.standardize_brightness(t).reshape((-1, 1, 3)) for t in tiles])
+        stain_matrix_source = get_stain_matrix(px)
+        source_concentrations = ut.get_concentrations(px, stain_matrix_source, method=self.method)
         max_c_source = np.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
-        max_c_target = np.percentile(self.target_concentrations, 99, axis=0).reshape((1, 2))
-        source_concentrations *= (max_c_target / max_c_source)
+
+        self.sources[key] = (stain_matrix_source, max_c_source)
+        return self.sources[key]
+
+    def transform(self, x, key=None):
+        """
+        Normalise an image to the target.
+
+        Args:
+            x: Image to normalise.
+            key: Slide of the image. Its stain matrix and concentrations are
+                 estimated from x the first time and reused for the next images,
+                 use fit_source() to estimate them from the whole slide instead.
+                 None estimates them for every image.
+        """
+        x = ut.standardize_brightness(x)
+        if key is not None:
+            if key not in self.sources:
+                self.fit_source(x, key)
+            stain_matrix_source, max_c_source = self.sources[key]
+            source_concentrations = ut.get_concentrations(x, stain_matrix_source, method=self.method)
+        else:
+            stain_matrix_source = get_stain_matrix(x)
+            source_concentrations = ut.get_concentrations(x, stain_matrix_source, method=self.method)
+            max_c_source = np.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
+        source_concentrations *= (self.max_c_target / max_c_source)
         return (255 * np.exp(-1 * np.dot(source_concentrations, self.stain_matrix_target).reshape(x.shape))).astype(
             np.uint8)
 
@@ -68,7 +159,7 @@ class Normalizer(object):
         x = ut.standardize_brightness(x)
         h, w, c = x.shape
         stain_matrix_source = get_stain_matrix(x)
-        source_concentrations = ut.get_concentrations(x, stain_matrix_source)
+        source_concentrations = ut.get_concentrations(x, stain_matrix_source, method=self.method)
         hh = source_concentrations[:, 0].reshape(h, w)
         hh = np.exp(-1 * hh)
         return hh
@@ -77,42 +168,76 @@ class Normalizer(object):
         x = ut.standardize_brightness(x)
         h, w, c = x.shape
         stain_matrix_source = get_stain_matrix(x)
-        source_concentrations = ut.get_concentrations(x, stain_matrix_source)
+        source_concentrations = ut.get_concentrations(x, stain_matrix_source, method=self.method)
         hh = source_concentrations[:, 1].reshape(h, w)
         hh = np.exp(-1 * hh)
         return hh
 
-def multi_apply_normalisation_to_images(path, nn_path, sl_format):
+def multi_apply_normalisation_to_images(path, nn_path, sl_format, metrics=None, profile=False, memory=False,
+                                        per_slide=False):
   """
   Apply normalisation to a set of slides
   Args:
     path: The image folder.
-    nn_path: The path to standard.
+    nn_path: The path to the standard image, or to a normalizer saved by Normalizer.save().
+             A normalizer fitted to an image is saved as normalised/normalizer.npz.
     sl_format: The format of the image to normalise.
+    metrics: JSON file for the per-stage timers and counters.
+    profile: Save a cProfile of every image next to the metrics file.
+    memory: Record the peak traced memory of every image.
+    per_slide: Estimate the source stains once per slide (see slide_key()), from its
+               scaled image when present in the folder or else from a sample of its tiles.
 
   Returns:
     Saves to normalisation folder
   """
 
-  timer = ut.Time()
-  sd = ut.read_image(nn_path)
-  sd_class = Normalizer()
-  sd_class.fit(sd)
-
+  timer = mt.start(metrics, profile=profile, memory=memory)
   n_path = os.path.join(path, "normalised")
   print(n_path)
 
+  if not os.path.exists(n_path):
+    os.makedirs(n_path)
+
+  if nn_path.endswith(".npz"):
+    sd_class = Normalizer.load(nn_path)
+  else:
+    sd_class = Normalizer()
+    sd_class.fit(ut.read_image(nn_path))
+    sd_class.save(os.path.join(n_path, "normalizer.npz"))
+
   files = [f for f in os.listdir(path) if f.endswith(sl_format)]
   print("Applying filters to {} image".format(len(files)))
 
-  if not os.path.exists(n_path):
-    os.makedirs(n_path)
+  if per_slide:
+    slides = {}
+    for i in sorted(files):
+      slides.setdefault(slide_key(i), []).append(i)
+
+    for key, group in slides.items():
+      with timer.stage("fit_source"):
+        thumb = [i for i in group if not TILE_NAME.match(i)]
+        try:
+          if thumb:
+            sd_class.fit_source(ut.read_image(os.path.join(path, thumb[0])), key)
+          else:
+            # Tissue-weighted sample out of at most 4 x SOURCE_TILES decoded tiles
+            pick = np.random.RandomState(0).permutation(len(group))[:4 * SOURCE_TILES]
+            sd_class.fit_source([ut.read_image(os.path.join(path, group[k])) for k in sorted(pick)], key)
+        except ValueError as e:
+          print("ALERT: {} not fitted as a slide, {}".format(key, e))
 
   for i in files:
-    sl = ut.read_image(os.path.join(path, i))
-    sl1 = sd_class.transform(sl)
-    sl1 = ut.np_to_pil(sl1)
-    sl1.save(os.path.join(n_path, i))
+    with timer.input(i):
+      sl = ut.read_image(os.path.join(path, i))
+      with timer.stage("normalise"):
+        try:
+          sl1 = sd_class.transform(sl, key=slide_key(i) if per_slide else None)
+        except ValueError as e:
+          print("ALERT: Skipped {}, {}".format(i, e))
+          continue
+      sl1 = ut.np_to_pil(sl1)
+      sl1.save(os.path.join(n_path, i))
 
   timer.elapsed_display()
   return
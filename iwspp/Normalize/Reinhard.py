@@ -71,6 +71,31 @@ class Normalizer(object):
         self.target_means = means
         self.target_stds = stds
 
+    def save(self, path):
+        """
+        Save the fitted target, see load().
+
+        Args:
+            path: File to write (.npz).
+        """
+        ut.save_normalizer(path, "reinhard", target_means=np.array(self.target_means),
+                           target_stds=np.array(self.target_stds))
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Get a fitted Normalizer from a file written by save().
+
+        Args:
+            path: File to read.
+        """
+        state = ut.load_normalizer(path, "reinhard")
+        norm = cls()
+        norm.target_means = tuple(state["target_means"])
+        norm.target_stds = tuple(state["target_stds"])
+        return norm
+
     def transform(self, I):
         I = ut.standardize_brightness(I)
         I1, I2, I3 = lab_split(I)
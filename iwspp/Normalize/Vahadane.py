@@ -9,17 +9,22 @@ import numpy as np
 import iwspp.flows.util as ut
 
 
-def get_stain_matrix(I, threshold=0.8, lamda=0.1):
+def get_stain_matrix(I, threshold=0.8, lamda=0.1, n=ut.STAIN_PIXELS, seed=0):
     """
     Get 2x3 stain matrix. First row H and second row E
+    The dictionary is learnt on a seeded sample of at most n not white pixels (see util.stain_sample).
     :param I:
     :param threshold:
     :param lamda:
+    :param n: Most pixels in the sample
+    :param seed: Seed of the sample
     :return:
     """
-    mask = ut.notwhite_mask(I, thresh=threshold).reshape((-1,))
-    OD = ut.RGB_to_OD(I).reshape((-1, 3))
-    OD = OD[mask]
+    _, OD = ut.stain_sample(I, lambda od, rgb: ut.not_white_mask(rgb[:, None, :], thresh=threshold)[:, 0],
+                            n=n, seed=seed)
+    if OD.shape[0] < 2:
+        raise ValueError("no tissue pixels to estimate stains from")
+    OD = np.ascontiguousarray(OD, dtype=np.float64)
     dictionary = spams.trainDL(OD.T, K=2, lambda1=lamda, mode=2, modeD=0, posAlpha=True,
                                posD=True, verbose=False).T
     if dictionary[0, 0] < dictionary[1, 0]:
@@ -33,20 +38,50 @@ class Normalizer(object):
     A stain normalization object
     """
 
-    def __init__(self):
+    def __init__(self, method="active_set"):
+        """
+        Normalizer class.
+
+        Parameters:
+            method: Concentration solver, "active_set" (NumPy) or "spams" (see util.get_concentrations).
+        """
+        self.method = method
         self.stain_matrix_target = None
 
     def fit(self, target):
         target = ut.standardize_brightness(target)
         self.stain_matrix_target = get_stain_matrix(target)
 
+    def save(self, path):
+        """
+        Save the fitted target, see load().
+
+        Args:
+            path: File to write (.npz).
+        """
+        ut.save_normalizer(path, "vahadane", method=self.method, stain_matrix_target=self.stain_matrix_target)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Get a fitted Normalizer from a file written by save().
+
+        Args:
+            path: File to read.
+        """
+        state = ut.load_normalizer(path, "vahadane")
+        norm = cls(method=str(state["method"]))
+        norm.stain_matrix_target = state["stain_matrix_target"]
+        return norm
+
     def target_stains(self):
-        return ut.OD_to_RGB(self.stain_matrix_target)
+        return ut.convert_rgb_od(self.stain_matrix_target, t="rgb")
 
     def transform(self, I):
         I = ut.standardize_brightness(I)
         stain_matrix_source = get_stain_matrix(I)
-        source_concentrations = ut.get_concentrations(I, stain_matrix_source)
+        source_concentrations = ut.get_concentrations(I, stain_matrix_source, method=self.method)
         return (255 * np.exp(-1 * np.dot(source_concentrations, self.stain_matrix_target).reshape(I.shape))).astype(
             np.uint8)
 
@@ -54,7 +89,7 @@ class Normalizer(object):
         I = ut.standardize_brightness(I)
         h, w, c = I.shape
         stain_matrix_source = get_stain_matrix(I)
-        source_concentrations = ut.get_concentrations(I, stain_matrix_source)
+        source_concentrations = ut.get_concentrations(I, stain_matrix_source, method=self.method)
         H = source_concentrations[:, 0].reshape(h, w)
         H = np.exp(-1 * H)
         return H
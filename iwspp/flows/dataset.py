@@ -0,0 +1,157 @@
+"""
+Name: dataset
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from iwspp.flows.shard import ShardReader
+from iwspp.flows.tilename import TILE_NAME
+
+# Folder of the unfiltered tiles of Tile(sa=True), a copy of the selected ones and more
+ALL_TILES = "allTile"
+
+
+class TileDataset:
+    """
+    Lazy access to the tiles written by Slide or Tile, for training.
+    The tile output is indexed once, tiles are decoded on demand as uint8 arrays
+    and batches are drawn through a bounded shuffle buffer, so memory does not
+    grow with the size of the dataset.
+    """
+
+    def __init__(self, path, pattern=".jpg", annotation="annotation.csv", cache=None):
+        """
+        TileDataset class.
+
+        Parameters:
+            path: Tile output folder, searched recursively for tar shards (*.tar.csv) or tile files.
+                  Only tile names (see tilename.TILE_NAME) are indexed, scaled slide images and
+                  the allTile folders are left out.
+            pattern: File extension of the tiles when there are no shards.
+            annotation: Name of the annotation tables joined on the tile name.
+            cache: Optional CSV file to save the index to and load it from on the next run.
+        """
+        self.path = path
+        self.__shards = None
+
+        if cache is not None and os.path.exists(cache):
+            self.index = pd.read_csv(cache)
+        else:
+            self.index = self.__build(pattern, annotation)
+            if cache is not None:
+                self.index.to_csv(cache, index=False)
+
+        if "shard" in self.index:
+            self.__shards = ShardReader(self.path, index=self.index)
+
+    def __str__(self):
+        return "Tile dataset of {} tiles in {}.".format(len(self), self.path)
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    def __build(self, pattern, annotation):
+        """
+        Index the shards, or the tile files with their annotation rows.
+        """
+        shards = ShardReader(self.path, prefix="*", recursive=True, exclude=(ALL_TILES,))
+        if len(shards):
+            return shards.index
+
+        parts = []
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = sorted(d for d in dirs if d != ALL_TILES)
+            names = sorted(f for f in files if f.endswith(pattern) and TILE_NAME.match(f))
+            if not names:
+                continue
+
+            part = pd.DataFrame({"Name": names})
+            if annotation in files:
+                part = part.merge(pd.read_csv(os.path.join(root, annotation)), on="Name", how="left")
+            part.insert(0, "file", [os.path.join(root, f) for f in names])
+            parts.append(part)
+
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["file", "Name"])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        """
+        Decode tile i as an RGB uint8 NumPy array.
+        """
+        if self.__shards is not None:
+            return self.__shards[i]
+        with Image.open(self.index["file"].iloc[i]) as img:
+            return np.asarray(img.convert("RGB"))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def batches(self, batch_size=32, shuffle=True, buffer=1024, seed=None, drop_last=False, shape=None):
+        """
+        Yield fixed-size batches of tiles with their index rows.
+        Tiles are read in storage order and shuffled through a buffer of at
+        most buffer decoded tiles, which bounds memory at any dataset size.
+        Tiles of another shape than the first one (or shape) are skipped.
+
+        Args:
+            batch_size: Number of tiles per batch.
+            shuffle: Shuffle the tiles through the buffer.
+            buffer: Maximum number of decoded tiles held for shuffling.
+            seed: Seed of the shuffle.
+            drop_last: Skip the last batch if it is smaller than batch_size.
+            shape: (H, W, 3) of the tiles, the shape of the first tile by default.
+        Returns:
+            Generator of ((batch_size, H, W, 3) uint8 NumPy array, DataFrame of index rows).
+        """
+        rng = np.random.default_rng(seed)
+        pool = []
+        batch = []
+
+        def take():
+            if shuffle:
+                k = rng.integers(len(pool))
+                pool[k], pool[-1] = pool[-1], pool[k]
+            return pool.pop()
+
+        def emit():
+            rows = self.index.iloc[[b[0] for b in batch]]
+            return np.stack([b[1] for b in batch]), rows
+
+        skipped = 0
+        for i in range(len(self)):
+            tile = self[i]
+            if shape is None:
+                shape = tile.shape
+            elif tile.shape != tuple(shape):
+                skipped += 1
+                continue
+            pool.append((i, tile))
+
+            if len(pool) >= (buffer if shuffle else 1):
+                batch.append(take())
+                if len(batch) == batch_size:
+                    yield emit()
+                    batch = []
+
+        while pool:
+            batch.append(take())
+            if len(batch) == batch_size:
+                yield emit()
+                batch = []
+
+        if batch and not drop_last:
+            yield emit()
+
+        if skipped:
+            print("ALERT: Skipped {} tiles that are not {}".format(skipped, tuple(shape)))
+
+    def close(self):
+        if self.__shards is not None:
+            self.__shards.close()
+        return
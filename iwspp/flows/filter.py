@@ -4,6 +4,10 @@ import os
 import skimage.color as sk_color
 from PIL import Image
 from iwspp.flows import util
+from iwspp.flows import metrics as mt
+
+# Pixels per chunk of the fused tissue kernel, bounds its temporaries to a few MB
+CHUNK_PIXELS = 2 ** 20
 
 
 def filter_grays(np_img, tolerance=15, output_type="bool"):
@@ -17,11 +21,7 @@ def filter_grays(np_img, tolerance=15, output_type="bool"):
     NumPy array representing a mask where pixels with similar red, green, and blue values have been masked out.
   """
 
-  rgb = np_img.astype(np.int)
-  rg_diff = abs(rgb[:, :, 0] - rgb[:, :, 1]) <= tolerance
-  rb_diff = abs(rgb[:, :, 0] - rgb[:, :, 2]) <= tolerance
-  gb_diff = abs(rgb[:, :, 1] - rgb[:, :, 2]) <= tolerance
-  result = ~(rg_diff & rb_diff & gb_diff)
+  result = tissue_mask(np_img, tolerance)
 
   if output_type == "bool":
     pass
@@ -33,6 +33,75 @@ def filter_grays(np_img, tolerance=15, output_type="bool"):
   return result
 
 
+def _spread(np_img, buf):
+  """
+  Channel spread (max - min) of uint8 RGB pixels, written into buf.
+  """
+  r, g, b = np_img[..., 0], np_img[..., 1], np_img[..., 2]
+  lo = np.minimum(r, g)
+  np.minimum(lo, b, out=lo)
+  np.maximum(r, g, out=buf)
+  np.maximum(buf, b, out=buf)
+  np.subtract(buf, lo, out=buf)
+  return buf
+
+
+def _chunks(np_img, chunk):
+  """
+  Row ranges of about chunk pixels over the (..., H, W, 3) image or stack.
+  """
+  h, w = np_img.shape[-3], np_img.shape[-2]
+  per_row = w * int(np.prod(np_img.shape[:-3], dtype=np.int64))
+  step = max(1, chunk // max(per_row, 1))
+  return [(r, min(r + step, h)) for r in range(0, h, step)]
+
+
+def tissue_mask(np_img, tolerance=15, chunk=CHUNK_PIXELS):
+  """
+  Mask of the pixels that are not gray, their red, green and blue values spread more than tolerance.
+  Works on the uint8 values in chunks of rows, the same mask as the int arithmetic of filter_grays().
+  Args:
+    np_img: RGB image (H, W, 3) or stack of tiles (N, H, W, 3) as a uint8 NumPy array.
+    tolerance: Largest channel spread still counted as gray.
+    chunk: Number of pixels processed at a time.
+  Returns:
+    Boolean NumPy array of shape (H, W) or (N, H, W), True for tissue.
+  """
+  out = np.empty(np_img.shape[:-1], dtype=bool)
+  for r0, r1 in _chunks(np_img, chunk):
+    part = np_img[..., r0:r1, :, :]
+    buf = _spread(part, np.empty(part.shape[:-1], dtype=np.uint8))
+    np.greater(buf, tolerance, out=out[..., r0:r1, :])
+  return out
+
+
+def tissue_fraction(np_img, tolerance=15, chunk=CHUNK_PIXELS):
+  """
+  Fraction of tissue (not gray) pixels, fused into one pass over the uint8 values.
+  No int cast, mask or masked RGB copy is made, temporaries hold at most chunk pixels.
+  Args:
+    np_img: RGB image (H, W, 3) or stack of tiles (N, H, W, 3) as a uint8 NumPy array.
+    tolerance: Largest channel spread still counted as gray.
+    chunk: Number of pixels processed at a time.
+  Returns:
+    Tissue fraction (0-1) of the image, or a (N,) NumPy array for a stack.
+  """
+  stack = np_img.reshape((-1,) + np_img.shape[-3:])
+  n, h, w = stack.shape[:3]
+  count = np.zeros(n, dtype=np.int64)
+  buf = None
+
+  for r0, r1 in _chunks(stack, chunk):
+    part = stack[:, r0:r1]
+    if buf is None or buf.shape != part.shape[:-1]:
+      buf = np.empty(part.shape[:-1], dtype=np.uint8)
+    _spread(part, buf)
+    count += np.count_nonzero((buf > tolerance).reshape(n, -1), axis=1)
+
+  frac = count / float(h * w)
+  return frac[0] if np_img.ndim == 3 else frac
+
+
 def mask_percent(np_img):
   """
   Determine the percentage of a NumPy array that is masked (how many of the values are 0 values).
@@ -144,17 +213,20 @@ def filter_hsv_to_v(hsv):
   return v
 
 
-def multi_apply_filters_to_images(path, sl_format):
+def multi_apply_filters_to_images(path, sl_format, metrics=None, profile=False, memory=False):
   """
   Apply a set of filters to image folder
   Args:
     path: The image folder.
     sl_format: The file format of the images.
+    metrics: JSON file for the per-stage timers and counters.
+    profile: Save a cProfile of every image next to the metrics file.
+    memory: Record the peak traced memory of every image.
   Returns:
     Tuple of 1) Dictionary of mask percentage and path to filtered images
   """
 
-  timer = util.Time()
+  timer = mt.start(metrics, profile=profile, memory=memory)
   info = dict()
   n_path = os.path.join(path, "filtered")
   print(n_path)
@@ -168,7 +240,8 @@ def multi_apply_filters_to_images(path, sl_format):
   for key, i in enumerate(files):
     sl = os.path.join(path, i)
     fps = os.path.join(n_path, i)
-    mask_per = apply_image_filters(sl, fps)
+    with timer.input(sl), timer.stage("filter"):
+      mask_per = apply_image_filters(sl, fps)
     info[key] = sl + "_" + fps + "==" + str(mask_per)
 
   info = pd.DataFrame(list(info.items()), columns=["key", "Mask"])
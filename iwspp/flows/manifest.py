@@ -0,0 +1,185 @@
+"""
+Name: manifest
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def file_key(path, content=False):
+    """
+    Identify the state of an input file.
+
+    Args:
+        path: Path to the file.
+        content: Add a SHA-1 of the file content, slower but survives copies and touch.
+    Returns:
+        Dictionary with the size, modification time and optionally the hash.
+    """
+    st = os.stat(path)
+    key = {"size": st.st_size, "mtime": st.st_mtime}
+
+    if content:
+        sha = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                sha.update(block)
+        key["sha1"] = sha.hexdigest()
+
+    return key
+
+
+class Manifest:
+    """
+    Journal of the inputs processed by a batch run, kept in the output root.
+    Every state change is appended as one JSON line so a killed run loses nothing,
+    the last line for an input wins when the journal is read back.
+    """
+
+    def __init__(self, root, params, content=False):
+        """
+        Manifest class.
+
+        Parameters:
+            root: Output folder of the run, the journal is written there.
+            params: Dictionary of the run parameters, a change redoes every input.
+            content: Compare inputs by content hash instead of size and mtime.
+        """
+        self.root = root
+        self.params = json.loads(json.dumps(params))
+        self.content = content
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.__entries = {}
+        self.__load()
+
+    def __str__(self):
+        return "Manifest of {} inputs in {}".format(len(self.__entries), self.path)
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    def __load(self):
+        """
+        Replay the journal, a truncated last line from a killed run is ignored.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                self.__entries[rec["input"]] = rec
+        return
+
+    def __append(self, rec):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        with open(self.path, "a") as fh:
+            fh.write(json.dumps(rec) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        self.__entries[rec["input"]] = rec
+        return
+
+    def done(self, x):
+        """
+        Check if an input was finished with the same file state and parameters.
+
+        Args:
+            x: Path to the input file.
+        """
+        rec = self.__entries.get(os.path.basename(x))
+        if rec is None or rec["status"] != "done" or rec["params"] != self.params:
+            return False
+        return rec["file"] == file_key(x, self.content)
+
+    def start(self, x, outputs):
+        """
+        Remove what an earlier attempt left for this input and record a new attempt.
+
+        Args:
+            x: Path to the input file.
+            outputs: Files or folders this input writes.
+        """
+        rec = self.__entries.get(os.path.basename(x))
+        if rec is not None:
+            clean(rec["outputs"])
+
+        self.__append({"input": os.path.basename(x), "status": "started",
+                       "file": file_key(x, self.content), "params": self.params,
+                       "outputs": [os.path.abspath(o) for o in outputs]})
+        return
+
+    def finish(self, x, error=None):
+        """
+        Record the end of an attempt.
+
+        Args:
+            x: Path to the input file.
+            error: Error message if the input failed.
+        """
+        rec = dict(self.__entries[os.path.basename(x)])
+        rec["status"] = "done" if error is None else "failed"
+        rec["error"] = error
+        self.__append(rec)
+        return
+
+
+def clean(outputs):
+    """
+    Delete files and folders left by an unfinished or outdated attempt.
+
+    Args:
+        outputs: List of paths to delete.
+    """
+    for o in outputs:
+        if os.path.isdir(o):
+            shutil.rmtree(o)
+        elif os.path.exists(o):
+            os.remove(o)
+    return
+
+
+def run_pool(calls, workers, finish):
+    """
+    Run the calls of a batch in a process pool and hand every result to finish.
+    A crashed worker (out of memory, segfault) breaks the pool and every call
+    still pending in it, so those calls are retried one at a time in their own
+    pool and only a call that crashes while running alone is reported failed.
+
+    Args:
+        calls: Dictionary of input to a picklable function of no arguments
+               (e.g. functools.partial) returning (input, error, metrics snapshot).
+        workers: Number of processes.
+        finish: Function of (input, error, snapshot) called for every input,
+                with error "worker process died" and no snapshot after a crash.
+    """
+    suspects = []
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(calls[x]): x for x in calls}
+        for fu in as_completed(futures):
+            try:
+                finish(*fu.result())
+            except BrokenProcessPool:
+                suspects.append(futures[fu])
+
+    for x in suspects:
+        with ProcessPoolExecutor(max_workers=1) as ex:
+            fu = ex.submit(calls[x])
+            try:
+                finish(*fu.result())
+            except BrokenProcessPool:
+                finish(x, "worker process died", None)
+    return
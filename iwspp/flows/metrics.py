@@ -0,0 +1,287 @@
+"""
+Name: metrics
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import json
+import time
+import datetime
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+# Timer used by every stage while metrics are disabled
+_NULL = contextlib.nullcontext()
+
+
+class Metrics:
+    """
+    Per-stage timers and counters for a batch run.
+    Stages are timed with `with metrics.stage("name"):` and events counted with
+    metrics.count("name", k). When disabled both return at once, so the calls
+    can stay in the hot paths.
+    """
+
+    def __init__(self, enabled=False, path=None, every=60, profile=False, memory=False):
+        """
+        Metrics class.
+
+        Parameters:
+            enabled: Collect timers and counters.
+            path: JSON file the report is written to, None only keeps it in memory.
+            every: Seconds between reports written during the run.
+            profile: Save a cProfile of every input next to the report (<report>.profiles/).
+            memory: Record the peak traced Python memory of every input with tracemalloc.
+        """
+        self.enabled = enabled
+        self.path = path
+        self.every = every
+        self.profile = profile
+        self.memory = memory
+        self.timers = {}
+        self.counters = {}
+        self.inputs = []
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+        self.__started = datetime.datetime.now()
+        self.__last = self.__start
+
+    def __str__(self):
+        return "Metrics of {} stages and {} inputs.".format(len(self.timers), len(self.inputs))
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    def config(self):
+        """
+        Settings to rebuild an equivalent, empty Metrics in a worker process.
+        Workers keep the path to place their profiles but never write the report.
+        """
+        return dict(enabled=self.enabled, path=self.path, every=0, profile=self.profile, memory=self.memory)
+
+    def stage(self, name):
+        """
+        Time a block of code under a stage name.
+
+        Args:
+            name: Name of the stage.
+        Returns:
+            Context manager.
+        """
+        if not self.enabled:
+            return _NULL
+        return self.__timer(name)
+
+    @contextlib.contextmanager
+    def __timer(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t)
+
+    def add(self, name, seconds, calls=1):
+        """
+        Add time to a stage.
+
+        Args:
+            name: Name of the stage.
+            seconds: Time spent.
+            calls: Number of calls the time covers.
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            tm = self.timers.setdefault(name, [0.0, 0])
+            tm[0] += seconds
+            tm[1] += calls
+        return
+
+    def count(self, name, k=1):
+        """
+        Increase a counter.
+
+        Args:
+            name: Name of the counter.
+            k: Amount to add.
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + int(k)
+        return
+
+    @contextlib.contextmanager
+    def input(self, x):
+        """
+        Record the duration of one input (slide or image), with its profile and
+        peak memory when requested. Errors are recorded and raised again.
+
+        Args:
+            x: Path to the input.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        name = os.path.basename(x)
+        rec = {"input": name}
+        prof = cProfile.Profile() if self.profile else None
+        trace = self.memory and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        if prof is not None:
+            prof.enable()
+
+        t = time.perf_counter()
+        try:
+            yield
+
+        except BaseException as err:
+            rec["error"] = repr(err)
+            raise
+
+        finally:
+            rec["seconds"] = time.perf_counter() - t
+            if prof is not None:
+                prof.disable()
+                rec["profile"] = self.__dump(prof, name)
+            if trace:
+                rec["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+                tracemalloc.stop()
+
+            with self.__lock:
+                self.inputs.append(rec)
+            self.count("inputs")
+            self.tick()
+
+    def __dump(self, prof, name):
+        root = (self.path or "metrics.json").rsplit(".", 1)[0] + ".profiles"
+        os.makedirs(root, exist_ok=True)
+        out = os.path.join(root, name + ".prof")
+        prof.dump_stats(out)
+        return os.path.abspath(out)
+
+    def snapshot(self, reset=False):
+        """
+        Copy of the timers, counters and inputs, for merging into another Metrics.
+
+        Args:
+            reset: Clear this Metrics after the copy.
+        """
+        with self.__lock:
+            snap = {"timers": {k: list(v) for k, v in self.timers.items()},
+                    "counters": dict(self.counters),
+                    "inputs": list(self.inputs)}
+            if reset:
+                self.timers, self.counters, self.inputs = {}, {}, []
+        return snap
+
+    def merge(self, snap):
+        """
+        Add a snapshot taken in another process.
+
+        Args:
+            snap: Dictionary from snapshot(), None is ignored.
+        """
+        if not self.enabled or not snap:
+            return
+        for k, (seconds, calls) in snap["timers"].items():
+            self.add(k, seconds, calls)
+        for k, v in snap["counters"].items():
+            self.count(k, v)
+        with self.__lock:
+            self.inputs.extend(snap["inputs"])
+        return
+
+    def report(self, final=True):
+        """
+        Build the report and write it to path when set.
+
+        Args:
+            final: Mark the report as the end of the run.
+        Returns:
+            The report as a dictionary.
+        """
+        elapsed = time.time() - self.__start
+        snap = self.snapshot()
+        written = snap["counters"].get("bytes_written", 0)
+        rep = {"started": self.__started.isoformat(),
+               "elapsed": elapsed,
+               "final": final,
+               "stages": {k: {"seconds": v[0], "calls": v[1]} for k, v in sorted(snap["timers"].items())},
+               "counters": snap["counters"],
+               "rates": {"tiles_written_per_s": snap["counters"].get("tiles_written", 0) / elapsed,
+                         "mb_written_per_s": written / 1e6 / elapsed},
+               "inputs": snap["inputs"]}
+
+        if self.path is not None:
+            # Write then rename so a reader never sees half a report
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as fh:
+                json.dump(rep, fh, indent=2)
+            os.replace(tmp, self.path)
+
+        self.__last = time.time()
+        return rep
+
+    def tick(self):
+        """
+        Write an intermediate report if every seconds passed since the last one.
+        """
+        if self.enabled and self.path is not None and self.every and time.time() - self.__last >= self.every:
+            self.report(final=False)
+        return
+
+    def elapsed_display(self):
+        """
+        Display the elapsed time, and write the final report when enabled.
+        """
+        print("Time elapsed: " + str(datetime.datetime.now() - self.__started))
+        if self.enabled:
+            self.report()
+            if self.path is not None:
+                print("Metrics are in {}".format(self.path))
+        return
+
+
+# Metrics of this process, disabled until a batch run configures them
+_METRICS = Metrics()
+
+
+def get():
+    """
+    Get the Metrics of this process.
+    """
+    return _METRICS
+
+
+def configure(enabled=False, path=None, every=60, profile=False, memory=False):
+    """
+    Replace the Metrics of this process with a new, empty one.
+    See Metrics for the arguments.
+
+    Returns:
+        The new Metrics.
+    """
+    global _METRICS
+    _METRICS = Metrics(enabled=enabled, path=path, every=every, profile=profile, memory=memory)
+    return _METRICS
+
+
+def start(metrics=None, profile=False, memory=False, every=60):
+    """
+    Configure the metrics for a multi_* run.
+
+    Args:
+        metrics: JSON file for the report, None disables collection.
+        profile: Save a cProfile of every input.
+        memory: Record the peak traced memory of every input.
+        every: Seconds between intermediate reports.
+    Returns:
+        The new Metrics.
+    """
+    return configure(enabled=metrics is not None or profile or memory, path=metrics,
+                     every=every, profile=profile, memory=memory)
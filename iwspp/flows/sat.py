@@ -0,0 +1,208 @@
+"""
+Name: sat
+Author: Chinedu A. Anene, Phd
+"""
+
+import math
+import numpy as np
+
+# Suffix of the saved summed-area tables
+SAT_SUFFIX = ".sat.npz"
+
+# Most cells of a table built from a saved tissue mask (16 MB as uint32)
+SAT_CELLS = 2 ** 22
+
+
+def integral(counts, dtype):
+    """
+    Summed-area table of a 2D array of counts, with a leading row and column of zeros.
+
+    Args:
+        counts: 2D NumPy array (boolean mask or per-cell counts).
+        dtype: Integer type of the table, large enough for the total.
+    """
+    h, w = counts.shape
+    table = np.zeros((h + 1, w + 1), dtype=dtype)
+    np.cumsum(counts, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, dtype=dtype, out=table[1:, 1:])
+    return table
+
+
+class SummedAreaTable:
+    """
+    Summed-area table (integral image) of a tissue mask.
+    Once built, the tissue fraction of any rectangle costs four lookups,
+    so tile sizes, overlaps and thresholds can be swept without pixel data.
+    Query coordinates are in a reference frame (usually level 0 of the slide)
+    that is downsample times larger than the mask. A table cell (one mask
+    pixel, or cell x cell of them for large masks) belongs to a rectangle
+    when its centre falls inside it.
+    """
+
+    def __init__(self, mask=None, downsample=1.0, table=None, cell=1, size=None):
+        """
+        SummedAreaTable class.
+
+        Parameters:
+            mask: Boolean tissue mask (h, w) to build the table from.
+            downsample: Size of a mask pixel in query coordinates, a number or (x, y).
+            table: Existing (h + 1, w + 1) table, instead of mask.
+            cell: Mask pixels per side of a table cell.
+            size: (h, w) of the mask in mask pixels, the table shape times cell by default.
+        """
+        if np.ndim(downsample) == 0:
+            downsample = (downsample, downsample)
+        self.downsample = (float(downsample[0]), float(downsample[1]))
+
+        if table is None:
+            h, w = mask.shape
+            table = integral(mask, np.uint32 if h * w < 2 ** 32 else np.uint64)
+        self.table = table
+        self.shape = (table.shape[0] - 1, table.shape[1] - 1)
+        self.cell = int(cell)
+        self.size = (self.shape[0] * self.cell, self.shape[1] * self.cell) if size is None else \
+            (int(size[0]), int(size[1]))
+
+    def __str__(self):
+        return "Summed-area table of a {} x {} mask, {:.1f}% tissue.".format(
+            self.size[1], self.size[0], 100 * self.total() / float(max(1, self.size[0] * self.size[1])))
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    @classmethod
+    def from_tissue_mask(cls, tm, max_cells=SAT_CELLS):
+        """
+        Build the table of a saved tissue mask on the tissue counts of cell x cell
+        squares of mask pixels, cell being the smallest that keeps the table
+        within max_cells. The mask is unpacked one band of blocks at a time, so
+        memory is bounded by max_cells and the band, not by the mask size.
+        Rectangles are resolved to whole cells, exact when cell is 1.
+
+        Args:
+            tm: TissueMask (see segment.TissueMask).
+            max_cells: Most cells of the table.
+        Returns:
+            SummedAreaTable in level 0 coordinates.
+        """
+        h, w = tm.shape
+        cell = max(1, int(math.ceil(math.sqrt(h * w / float(max_cells)))))
+        while math.ceil(h / float(cell)) * math.ceil(w / float(cell)) > max_cells:
+            cell += 1
+
+        dtype = np.uint32 if h * w < 2 ** 32 else np.uint64
+        counts = np.zeros((int(math.ceil(h / float(cell))), int(math.ceil(w / float(cell)))), dtype=dtype)
+        band = cell * max(1, tm.block // cell)
+        for y0 in range(0, h, band):
+            part = tm.region(0, y0, w, band)
+            part = np.add.reduceat(part, np.arange(0, part.shape[0], cell), axis=0, dtype=dtype)
+            part = np.add.reduceat(part, np.arange(0, w, cell), axis=1, dtype=dtype)
+            counts[y0 // cell:y0 // cell + part.shape[0]] = part
+
+        return cls(table=integral(counts, dtype), downsample=tm.downsample, cell=cell, size=(h, w))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a table saved by save().
+
+        Args:
+            path: File to read.
+        """
+        with np.load(path) as f:
+            if "cell" not in f.files:
+                return cls(table=f["table"], downsample=tuple(f["downsample"]))
+            return cls(table=f["table"], downsample=tuple(f["downsample"]), cell=int(f["cell"]),
+                       size=tuple(f["size"]))
+
+    def save(self, path):
+        """
+        Save the table, uncompressed so loading is a single read.
+
+        Args:
+            path: File to write, conventionally ending with SAT_SUFFIX.
+        """
+        np.savez(path, table=self.table, downsample=np.array(self.downsample), cell=self.cell,
+                 size=np.array(self.size))
+        return
+
+    def total(self):
+        """
+        Number of tissue pixels in the whole mask.
+        """
+        return int(self.table[-1, -1])
+
+    def __bounds(self, x, y, w, h):
+        """
+        Table cell ranges whose centres fall in the rectangles, clipped to the mask.
+        """
+        dx, dy = self.downsample[0] * self.cell, self.downsample[1] * self.cell
+        x0 = np.clip(np.ceil(np.asarray(x, dtype=np.float64) / dx - 0.5), 0, self.shape[1]).astype(np.int64)
+        x1 = np.clip(np.ceil((np.asarray(x) + np.asarray(w)) / dx - 0.5), 0, self.shape[1]).astype(np.int64)
+        y0 = np.clip(np.ceil(np.asarray(y, dtype=np.float64) / dy - 0.5), 0, self.shape[0]).astype(np.int64)
+        y1 = np.clip(np.ceil((np.asarray(y) + np.asarray(h)) / dy - 0.5), 0, self.shape[0]).astype(np.int64)
+        return x0, y0, np.maximum(x1, x0), np.maximum(y1, y0)
+
+    def sums(self, x, y, w, h):
+        """
+        Number of tissue and of all mask pixels in rectangles, vectorized.
+
+        Args:
+            x: Left of the rectangles, number or NumPy array.
+            y: Top of the rectangles.
+            w: Width of the rectangles.
+            h: Height of the rectangles.
+        Returns:
+            Tuple of (tissue pixels, mask pixels), same shape as the inputs.
+        """
+        x0, y0, x1, y1 = self.__bounds(x, y, w, h)
+        s = self.table
+        tissue = (s[y1, x1].astype(np.int64) - s[y0, x1] - s[y1, x0] + s[y0, x0])
+        # Cells of the last row and column can be cut by the mask edge
+        c = self.cell
+        area_x = np.minimum(x1 * c, self.size[1]) - np.minimum(x0 * c, self.size[1])
+        area_y = np.minimum(y1 * c, self.size[0]) - np.minimum(y0 * c, self.size[0])
+        return tissue, area_x * area_y
+
+    def fractions(self, x, y, w, h):
+        """
+        Tissue fraction (0-1) of rectangles in constant time each, vectorized.
+        Rectangles covering no mask pixel have a fraction of 0.
+
+        Args:
+            x: Left of the rectangles, number or NumPy array.
+            y: Top of the rectangles.
+            w: Width of the rectangles.
+            h: Height of the rectangles.
+        Returns:
+            NumPy array of fractions, same shape as the inputs.
+        """
+        tissue, area = self.sums(x, y, w, h)
+        return tissue / np.maximum(area, 1)
+
+    def fraction(self, x, y, w, h):
+        """
+        Tissue fraction (0-1) of a single rectangle (x, y, w, h).
+        """
+        return float(self.fractions(x, y, w, h))
+
+    def grid(self, step_x, step_y, cols, rows, size_x=None, size_y=None):
+        """
+        Tissue percentage of every tile of a regular grid.
+
+        Args:
+            step_x: Horizontal distance between tiles.
+            step_y: Vertical distance between tiles.
+            cols: Number of tile columns.
+            rows: Number of tile rows.
+            size_x: Tile width, step_x by default (larger for overlapping tiles).
+            size_y: Tile height, step_y by default.
+        Returns:
+            Tissue percentage of each tile as a (cols, rows) NumPy array.
+        """
+        size_x = step_x if size_x is None else size_x
+        size_y = step_y if size_y is None else size_y
+        xs = (np.arange(cols) * step_x)[:, None]
+        ys = (np.arange(rows) * step_y)[None, :]
+        return 100 * self.fractions(xs, ys, size_x, size_y)
+
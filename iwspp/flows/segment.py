@@ -0,0 +1,435 @@
+"""
+Name: segment
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import math
+import numpy as np
+import pandas as pd
+import openslide as op
+import functools
+from scipy import ndimage
+from skimage.filters import threshold_otsu
+from iwspp.flows import metrics as mt
+from iwspp.flows import stain
+from iwspp.flows.util import OD_LUT
+from iwspp.flows.manifest import Manifest, run_pool
+
+# Mask pixels per side of a stored block
+MASK_BLOCK = 2048
+
+# Suffix of the saved tissue masks
+MASK_SUFFIX = ".mask.npz"
+
+# Suffix of the packed bits of the mixed blocks, saved next to the mask
+BITS_SUFFIX = ".bits"
+
+# Block states in the saved mask
+EMPTY, FULL, MIXED = 0, 1, 2
+
+# Hues (degrees) of green and cyan pen marks, H&E stains sit outside them
+PEN_HUES = (90, 200)
+
+# Hues of blue pen marks and the saturation above which they are rejected. Hematoxylin
+# can be as blue, e.g. (70, 80, 160) has hue 233, but is less saturated (0.56) than ink
+BLUE_PEN_HUES = (200, 250)
+BLUE_PEN_SATURATION = 0.75
+
+# Longest side of the thumbnail the thresholds are computed on
+THUMB_SIZE = 2048
+
+
+def saturation_od(rgb):
+    """
+    Saturation and mean optical density (see util.OD_LUT) of RGB pixels.
+
+    Args:
+        rgb: RGB pixels as a (..., 3) uint8 NumPy array.
+    Returns:
+        Tuple of float32 arrays (saturation 0-1, mean optical density).
+    """
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    mx = np.maximum(np.maximum(r, g), b)
+    mn = np.minimum(np.minimum(r, g), b)
+    sat = (mx - mn).astype(np.float32) / np.maximum(mx, 1)
+    od = (OD_LUT[r] + OD_LUT[g] + OD_LUT[b]) / 3
+    return sat, od
+
+
+def remove_small(mask, min_area):
+    """
+    Remove the connected objects smaller than min_area pixels.
+
+    Args:
+        mask: Boolean NumPy array.
+        min_area: Smallest object kept, in pixels.
+    """
+    lab, n = ndimage.label(mask)
+    if n == 0:
+        return mask
+    keep = np.bincount(lab.ravel()) >= min_area
+    keep[0] = False
+    return keep[lab]
+
+
+def tissue_block(rgba, t_sat, od_min=0.1, dark=40, radius=2, min_area=64):
+    """
+    Tissue mask of one block of a slide level.
+    Tissue is saturated (above the Otsu threshold) and not background (optical
+    density above od_min), green, cyan and saturated blue pen marks and very
+    dark pixels are rejected, then
+    the mask is cleaned with an opening, a closing and small-object removal.
+
+    Args:
+        rgba: Block as a (h, w, 4) uint8 NumPy array from OpenSlide.read_region.
+        t_sat: Saturation threshold.
+        od_min: Mean optical density below which a pixel is background.
+        dark: Pixels with every channel below this are rejected (black pen, dust).
+        radius: Radius of the morphological cleanup, 0 skips it.
+        min_area: Smallest tissue object kept, in pixels, 0 keeps all.
+    Returns:
+        Boolean (h, w) NumPy array, True for tissue.
+    """
+    rgb = rgba[..., :3]
+    sat, od = saturation_od(rgb)
+    mask = (sat > t_sat) & (od > od_min) & (rgba[..., 3] > 0)
+
+    hu, _, _ = stain.tile_hsv(rgb)
+    mask &= ~((hu >= PEN_HUES[0]) & (hu < PEN_HUES[1]))
+    mask &= ~((hu >= BLUE_PEN_HUES[0]) & (hu <= BLUE_PEN_HUES[1]) & (sat > BLUE_PEN_SATURATION))
+    mask &= rgb.max(axis=-1) >= dark
+
+    if radius:
+        disk = np.hypot(*np.mgrid[-radius:radius + 1, -radius:radius + 1]) <= radius
+        mask = ndimage.binary_opening(mask, structure=disk)
+        mask = ndimage.binary_closing(mask, structure=disk)
+
+    if min_area:
+        mask = remove_small(mask, min_area)
+    return mask
+
+
+def otsu_threshold(slide, size=THUMB_SIZE):
+    """
+    Otsu saturation threshold of the slide, computed once on a thumbnail so
+    every block is segmented with the same threshold.
+
+    Args:
+        slide: OpenSlide object.
+        size: Longest side of the thumbnail.
+    """
+    thumb = np.asarray(slide.get_thumbnail((size, size)).convert("RGB"))
+    sat, _ = saturation_od(thumb)
+    if sat.min() == sat.max():
+        return float(sat.max())
+    return float(threshold_otsu(sat))
+
+
+def segment_slide(x, out, s=16, block=MASK_BLOCK, halo=32, od_min=0.1, dark=40, radius=2, min_area=64):
+    """
+    Segment the tissue of a slide at the level closest to downsample s.
+    The level is streamed block by block, each block is read with halo extra
+    pixels on every side so the cleanup sees its neighbours. The packed bits of
+    the mixed blocks are appended to a file next to the mask (see bits_path) as
+    they are made, only the per-block state, counts and offsets stay in memory.
+
+    Args:
+        x: Path to the slide.
+        out: .npz file to save the mask to (see TissueMask).
+        s: Downsample of the mask against level 0, the nearest pyramid level is used.
+        block: Mask pixels per side of a block.
+        halo: Extra pixels read around each block, should exceed radius and the small objects.
+        od_min: Mean optical density below which a pixel is background.
+        dark: Pixels with every channel below this are rejected.
+        radius: Radius of the morphological cleanup.
+        min_area: Smallest tissue object kept, in mask pixels.
+    Returns:
+        Path to the saved mask.
+    """
+    m = mt.get()
+    slide = op.open_slide(x)
+    try:
+        return _segment_level(slide, out, s, block, halo, od_min, dark, radius, min_area)
+    finally:
+        slide.close()
+
+
+def _segment_level(slide, out, s, block, halo, od_min, dark, radius, min_area):
+    """
+    Body of segment_slide() on an open slide, see segment_slide() for the arguments.
+    """
+    m = mt.get()
+    level = slide.get_best_level_for_downsample(s)
+    l_w, l_h = slide.level_dimensions[level]
+    ds = slide.level_downsamples[level]
+
+    with m.stage("threshold"):
+        t_sat = otsu_threshold(slide)
+
+    nbx, nby = int(math.ceil(l_w / block)), int(math.ceil(l_h / block))
+    state = np.zeros((nby, nbx), dtype=np.uint8)
+    counts = np.zeros((nby, nbx), dtype=np.int64)
+    offsets = np.zeros((nby, nbx), dtype=np.int64)
+    pos = 0
+
+    with open(bits_path(out), "wb") as bits:
+        for by in range(nby):
+            for bx in range(nbx):
+                x0, y0 = bx * block, by * block
+                x1, y1 = min(x0 + block, l_w), min(y0 + block, l_h)
+                hx0, hy0 = max(0, x0 - halo), max(0, y0 - halo)
+                hx1, hy1 = min(l_w, x1 + halo), min(l_h, y1 + halo)
+
+                with m.stage("slide_read"):
+                    rgba = np.asarray(slide.read_region((int(round(hx0 * ds)), int(round(hy0 * ds))), level,
+                                                        (hx1 - hx0, hy1 - hy0)))
+                with m.stage("segment"):
+                    mask = tissue_block(rgba, t_sat, od_min=od_min, dark=dark, radius=radius,
+                                        min_area=min_area)[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+                c = np.count_nonzero(mask)
+                counts[by, bx] = c
+                if c == 0:
+                    state[by, bx] = EMPTY
+                elif c == mask.size:
+                    state[by, bx] = FULL
+                else:
+                    packed = np.packbits(mask, axis=None)
+                    state[by, bx] = MIXED
+                    offsets[by, bx] = pos
+                    bits.write(packed.tobytes())
+                    pos += packed.size
+                m.count("mask_blocks")
+
+    dims = slide.dimensions
+    # Saved last, a mask file means its bits are complete
+    np.savez_compressed(out, shape=np.array([l_h, l_w]), block=block, level=level, downsample=ds,
+                        dimensions=np.array(dims), threshold=t_sat, od_min=od_min,
+                        state=state, counts=counts, offsets=offsets, size=pos)
+    return out
+
+
+def bits_path(out):
+    """
+    File of the packed bits of the mask saved to out by segment_slide().
+
+    Args:
+        out: Path to the mask (.npz).
+    """
+    return (out[:-4] if out.endswith(".npz") else out) + BITS_SUFFIX
+
+
+class TissueMask:
+    """
+    Tissue mask saved by segment_slide(), kept bit-packed on disk.
+    The mask is stored in square blocks, blocks that are all background or all
+    tissue are only flagged, mixed blocks hold their packed bits in a
+    memory-mapped file so only the blocks that are read are paged in. Coordinates
+    of region() are mask pixels, those of fraction() are level 0 pixels.
+    """
+
+    def __init__(self, path):
+        """
+        TissueMask class.
+
+        Parameters:
+            path: File written by segment_slide().
+        """
+        self.path = path
+        with np.load(path) as f:
+            self.shape = tuple(int(i) for i in f["shape"])
+            self.block = int(f["block"])
+            self.level = int(f["level"])
+            self.downsample = float(f["downsample"])
+            self.dimensions = tuple(int(i) for i in f["dimensions"])
+            self.threshold = float(f["threshold"])
+            self.state = f["state"]
+            self.counts = f["counts"]
+            self.__offsets = f["offsets"]
+            size = int(f["size"])
+
+        # np.memmap cannot map an empty file
+        if size:
+            self.__data = np.memmap(bits_path(path), dtype=np.uint8, mode="r", shape=(size,))
+        else:
+            self.__data = np.zeros(0, dtype=np.uint8)
+
+    def __str__(self):
+        return "Tissue mask {} x {} at level {}, {:.1f}% tissue.".format(
+            self.shape[1], self.shape[0], self.level, 100 * self.tissue_fraction())
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    def tissue_fraction(self):
+        """
+        Fraction of the whole mask that is tissue.
+        """
+        return self.counts.sum() / float(self.shape[0] * self.shape[1])
+
+    def __bounds(self, by, bx):
+        y0, x0 = by * self.block, bx * self.block
+        return y0, x0, min(y0 + self.block, self.shape[0]), min(x0 + self.block, self.shape[1])
+
+    def get_block(self, by, bx):
+        """
+        Unpack one block of the mask.
+
+        Args:
+            by: Block row.
+            bx: Block column.
+        Returns:
+            Boolean NumPy array of the block.
+        """
+        y0, x0, y1, x1 = self.__bounds(by, bx)
+        st = self.state[by, bx]
+        if st != MIXED:
+            return np.full((y1 - y0, x1 - x0), st == FULL, dtype=bool)
+
+        n = (y1 - y0) * (x1 - x0)
+        off = int(self.__offsets[by, bx])
+        bits = np.unpackbits(self.__data[off:off + (n + 7) // 8], count=n)
+        return bits.reshape(y1 - y0, x1 - x0).astype(bool)
+
+    def region(self, x, y, w, h):
+        """
+        Unpack a rectangle of the mask, clipped to the mask.
+
+        Args:
+            x: Left column in mask pixels.
+            y: Top row in mask pixels.
+            w: Width in mask pixels.
+            h: Height in mask pixels.
+        Returns:
+            Boolean NumPy array of the rectangle.
+        """
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1, y1 = min(self.shape[1], int(x + w)), min(self.shape[0], int(y + h))
+        out = np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=bool)
+        if out.size == 0:
+            return out
+
+        for by in range(y0 // self.block, (y1 - 1) // self.block + 1):
+            for bx in range(x0 // self.block, (x1 - 1) // self.block + 1):
+                if self.state[by, bx] == EMPTY:
+                    continue
+                b0, a0, b1, a1 = self.__bounds(by, bx)
+                sy0, sy1 = max(y0, b0), min(y1, b1)
+                sx0, sx1 = max(x0, a0), min(x1, a1)
+                out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = \
+                    self.get_block(by, bx)[sy0 - b0:sy1 - b0, sx0 - a0:sx1 - a0]
+        return out
+
+    def to_array(self):
+        """
+        Unpack the whole mask.
+        """
+        return self.region(0, 0, self.shape[1], self.shape[0])
+
+    def fraction(self, x, y, w, h):
+        """
+        Tissue fraction of a rectangle given in level 0 pixels.
+
+        Args:
+            x: Left of the rectangle.
+            y: Top of the rectangle.
+            w: Width of the rectangle.
+            h: Height of the rectangle.
+        """
+        ds = self.downsample
+        reg = self.region(math.floor(x / ds), math.floor(y / ds),
+                          max(1, int(round(w / ds))), max(1, int(round(h / ds))))
+        return reg.mean() if reg.size else 0.0
+
+
+def mask_path(path, x):
+    """
+    Where the mask of slide x is saved by multi_segment_slides().
+
+    Args:
+        path: Slide folder.
+        x: Slide file name or path.
+    """
+    return os.path.join(path, "masks", os.path.basename(x)[:-4] + MASK_SUFFIX)
+
+
+def _segment_one(x, out, cfg=None, **kwargs):
+    """
+    Segment one slide, errors are returned instead of raised.
+    """
+    m = mt.get() if cfg is None else mt.configure(**cfg)
+    err = None
+    try:
+        with m.input(x):
+            segment_slide(x, out, **kwargs)
+    except Exception as e:
+        err = repr(e)
+    return x, err, (m.snapshot(reset=True) if cfg is not None and m.enabled else None)
+
+
+def multi_segment_slides(path, tf=".svs", s=16, block=MASK_BLOCK, halo=32, radius=2, min_area=64,
+                         workers=1, resume=True, metrics=None, profile=False, memory=False):
+    """
+    Segment the tissue of every slide in a folder into the "masks" folder.
+    Progress is journaled in masks/manifest.jsonl, a rerun skips the slides
+    already segmented with the same parameters.
+
+    Args:
+        path: Slide folder.
+        tf: Universal file extension of the slides.
+        s: Downsample of the masks against level 0.
+        block: Mask pixels per side of a block.
+        halo: Extra pixels read around each block.
+        radius: Radius of the morphological cleanup.
+        min_area: Smallest tissue object kept, in mask pixels.
+        workers: Number of slides to segment at the same time.
+        resume: Skip the slides the manifest marks as done.
+        metrics: JSON file for the per-stage timers and counters.
+        profile: Save a cProfile of every slide next to the metrics file.
+        memory: Record the peak traced memory of every slide.
+    """
+    timer = mt.start(metrics, profile=profile, memory=memory)
+
+    n_path = os.path.join(path, "masks")
+    if not os.path.exists(n_path):
+        os.makedirs(n_path)
+        print("ATTENTION: Tissue masks are in {}".format(n_path))
+
+    kwargs = dict(s=s, block=block, halo=halo, radius=radius, min_area=min_area)
+    jobs = [str(os.path.join(path, i)) for i in sorted(os.listdir(path)) if i.endswith(tf)]
+    manifest = Manifest(n_path, kwargs)
+    if resume:
+        jobs = [x for x in jobs if not manifest.done(x)]
+    print("Segmenting {} slides".format(len(jobs)))
+
+    failed = []
+    if workers > 1:
+        def finish(x, err, snap=None):
+            timer.merge(snap)
+            manifest.finish(x, err)
+            if err is not None:
+                failed.append((x, err))
+            print("{} {}".format(os.path.basename(x), "failed" if err else "done"))
+
+        for x in jobs:
+            manifest.start(x, [mask_path(path, x), bits_path(mask_path(path, x))])
+        # A crashed worker only fails its own slide, see manifest.run_pool
+        run_pool({x: functools.partial(_segment_one, x, mask_path(path, x), timer.config(), **kwargs)
+                  for x in jobs}, workers, finish)
+    else:
+        for x in jobs:
+            print(os.path.basename(x))
+            manifest.start(x, [mask_path(path, x), bits_path(mask_path(path, x))])
+            _, err, _ = _segment_one(x, mask_path(path, x), **kwargs)
+            manifest.finish(x, err)
+            if err is not None:
+                failed.append((x, err))
+
+    if failed:
+        print("ERROR: {} of {} slides failed, see failed.csv".format(len(failed), len(jobs)))
+        pd.DataFrame(failed, columns=["Slide", "Error"]).to_csv(os.path.join(n_path, "failed.csv"),
+                                                                 index=False)
+
+    timer.elapsed_display()
+    return
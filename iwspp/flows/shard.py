@@ -0,0 +1,201 @@
+"""
+Name: shard
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import io
+import glob
+import tarfile
+import threading
+import numpy as np
+import pandas as pd
+from PIL import Image
+from iwspp.flows.writer import TileWriter
+
+# Tiles per tar shard
+SHARD_TILES = 10000
+
+
+def shard_name(root, prefix, k):
+    return os.path.join(root, "{}-{:05d}.tar".format(prefix, k))
+
+
+class ShardWriter(TileWriter):
+    """
+    Append encoded tiles to tar shards instead of writing one file per tile.
+    Every shard gets an index (<shard>.csv) with the member name, the byte
+    offset and size of the tile data and the tile metadata (slide, x, y,
+    level and scores), so a reader can seek straight to any tile.
+    The shards stay plain tar files.
+    """
+
+    def __init__(self, root, prefix="tiles", max_tiles=SHARD_TILES, threads=4, queue=64, fmt="JPEG"):
+        """
+        ShardWriter class.
+
+        Parameters:
+            root: Folder to write the shards to.
+            prefix: File name prefix of the shards.
+            max_tiles: Maximum number of tiles per shard.
+            threads: Number of encoding threads.
+            queue: Maximum number of tiles waiting to be written.
+            fmt: PIL format to encode the tiles with.
+        """
+        TileWriter.__init__(self, threads=threads, queue=queue, fmt=fmt)
+        self.root = root
+        self.prefix = prefix
+        self.max_tiles = max_tiles
+        self.__tar = None
+        self.__shard = -1
+        self.__rows = []
+        self.__meta = {}
+        self.__tar_lock = threading.Lock()
+
+        # Drop the shards of an earlier run with the same prefix
+        for old in glob.glob(os.path.join(root, prefix + "-*.tar*")):
+            os.remove(old)
+
+    def __str__(self):
+        return "Shard writer, {} tiles in {} shards.".format(self.tiles, self.__shard + 1)
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return TileWriter.__exit__(self, exc_type, exc, tb)
+        finally:
+            self.__finish()
+
+    def submit(self, img, path, meta=None):
+        """
+        Queue a tile for the current shard, blocks while the queue is full.
+
+        Args:
+            img: Tile as a PIL image or an RGB NumPy array.
+            path: Tile file name, only the base name is kept as the member name.
+            meta: Dictionary of metadata columns for the index.
+        """
+        name = os.path.basename(path)
+        self.__meta[name] = meta or {}
+        TileWriter.submit(self, img, os.path.join(self.root, name))
+        return
+
+    def _put(self, path, data):
+        name = os.path.basename(path)
+
+        with self.__tar_lock:
+            if self.__tar is None or len(self.__rows) >= self.max_tiles:
+                self.__finish()
+                self.__shard += 1
+                self.mkdirs([self.root])
+                self.__tar = tarfile.open(shard_name(self.root, self.prefix, self.__shard), "w")
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            self.__tar.addfile(info, io.BytesIO(data))
+
+            # Data ends at the current offset, padded to whole blocks
+            blocks = -(-len(data) // tarfile.BLOCKSIZE)
+            offset = self.__tar.offset - blocks * tarfile.BLOCKSIZE
+
+            row = {"name": name, "offset": offset, "size": len(data)}
+            row.update(self.__meta.pop(name, {}))
+            self.__rows.append(row)
+        return
+
+    def __finish(self):
+        """
+        Close the open shard and write its index.
+        """
+        if self.__tar is None:
+            return
+
+        self.__tar.close()
+        pd.DataFrame(self.__rows).to_csv(shard_name(self.root, self.prefix, self.__shard) + ".csv",
+                                         index=False)
+        self.__tar = None
+        self.__rows = []
+        return
+
+    def close(self):
+        """
+        Wait for every queued tile, close the last shard and raise the first write error if any.
+        """
+        try:
+            TileWriter.close(self)
+        finally:
+            with self.__tar_lock:
+                self.__finish()
+        return
+
+
+class ShardReader:
+    """
+    Random access to the tiles of the shards in a folder.
+    """
+
+    def __init__(self, root, prefix="tiles", recursive=False, exclude=(), index=None):
+        """
+        ShardReader class.
+
+        Parameters:
+            root: Folder holding the shards.
+            prefix: File name prefix of the shards, "*" for any.
+            recursive: Also read the shards in the subfolders of root.
+            exclude: Names of subfolders whose shards are left out.
+            index: Index of an earlier reader (the index attribute), instead of reading root.
+        """
+        self.root = root
+        self.prefix = prefix
+        self.__files = {}
+
+        if index is not None:
+            self.index = index.reset_index(drop=True)
+            return
+
+        parts = []
+        pattern = os.path.join(root, "**", prefix + "-*.tar.csv") if recursive else \
+            os.path.join(root, prefix + "-*.tar.csv")
+        for idx in sorted(glob.glob(pattern, recursive=recursive)):
+            if set(os.path.relpath(idx, root).split(os.sep)[:-1]) & set(exclude):
+                continue
+            part = pd.read_csv(idx)
+            part.insert(0, "shard", idx[:-4])
+            parts.append(part)
+
+        self.index = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+    def __str__(self):
+        return "Shard reader, {} tiles in {}.".format(len(self), self.root)
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_bytes(self, i):
+        """
+        Get the encoded bytes of tile i.
+
+        Args:
+            i: Position of the tile in the index.
+        """
+        row = self.index.iloc[i]
+        fh = self.__files.get(row["shard"])
+        if fh is None:
+            fh = self.__files[row["shard"]] = open(row["shard"], "rb")
+        fh.seek(int(row["offset"]))
+        return fh.read(int(row["size"]))
+
+    def __getitem__(self, i):
+        """
+        Decode tile i as an RGB uint8 NumPy array.
+        """
+        with Image.open(io.BytesIO(self.read_bytes(i))) as img:
+            return np.asarray(img.convert("RGB"))
+
+    def close(self):
+        for fh in self.__files.values():
+            fh.close()
+        self.__files = {}
+        return
@@ -6,13 +6,34 @@ Author: Chinedu A. Anene, Phd
 import os
 import sys
 import math
+import heapq
+import functools
+import contextlib
+import multiprocessing as mp
 import openslide as op
 import numpy as np
 import pandas as pd
 from openslide.deepzoom import DeepZoomGenerator
 import PIL
 from iwspp.flows import util, filter, stain
-from iwspp.flows.util import Time
+from iwspp.flows import metrics as mt
+from iwspp.flows.manifest import Manifest, run_pool
+from iwspp.flows.writer import TileWriter
+from iwspp.flows.shard import ShardWriter
+from iwspp.flows.segment import TissueMask, mask_path
+from iwspp.flows.sat import SummedAreaTable, SAT_SUFFIX
+
+# Tiles estimated this many percentage points below the threshold are still read
+PLAN_SLACK = 20
+
+# Level pixels read per strip when building the scaled image
+STRIP_PIXELS = 2 ** 24
+
+# Per-process slide handle used by the tile extraction workers
+_ZOOM = {}
+
+# Tile selection modes of Slide.fit()
+SELECT_MODES = ("sample", "top", "stratified")
 
 
 def heatmap_value(x, fun=True):
@@ -27,12 +48,230 @@ def heatmap_value(x, fun=True):
 
     # Note that this function can hold anything
     np_img = util.pil_to_np_rgb(x)
-    mask_not_gray = filter.filter_grays(np_img)
-    rgb_not_gray = util.mask_rgb(np_img, mask_not_gray)
-    tp = filter.tissue_percent(rgb_not_gray)
+    tp = filter.tissue_fraction(np_img) * 100
     return tp
 
 
+def tissue_index(np_image, dimensions):
+  """
+  Summed-area table of the tissue mask of the scaled image, in level 0 coordinates.
+
+  Args:
+    np_image: Scaled image of the slide as a NumPy array.
+    dimensions: (width, height) of level 0 of the slide.
+  Returns:
+    SummedAreaTable (see sat.SummedAreaTable).
+  """
+  mask = filter.tissue_mask(np_image)
+  return SummedAreaTable(mask, (dimensions[0] / float(mask.shape[1]), dimensions[1] / float(mask.shape[0])))
+
+
+def tissue_grid(index, hzl, level, t):
+  """
+  Tissue percentage of every DeepZoom tile from a summed-area table, no tile is read.
+
+  Args:
+    index: SummedAreaTable of the slide in level 0 coordinates.
+    hzl: DeepZoomGenerator of the slide.
+    level: DeepZoom level of the tiles.
+    t: Size of the tiles.
+  Returns:
+    Tissue percentage of each tile as a (cols, rows) NumPy array.
+  """
+  cols, rows = hzl.level_tiles[level]
+  z = 2 ** (hzl.level_count - 1 - level)
+  return index.grid(t * z, t * z, cols, rows)
+
+
+def plan_tiles(grid, threshold, slack=PLAN_SLACK):
+  """
+  Select the DeepZoom tiles worth reading from their estimated tissue percentage.
+
+  Args:
+    grid: Tissue percentage of each tile (cols, rows), see tissue_grid().
+    threshold: Tissue percentage threshold.
+    slack: Percentage points below threshold still worth reading.
+  Returns:
+    List of (col, row) tiles, in the same order get_zoom() visits them.
+  """
+  cols, rows = grid.shape
+  return [(c, r) for c in range(cols) for r in range(rows) if grid[c, r] >= threshold - slack]
+
+
+def read_scaled(slide, le, size, max_pixels=STRIP_PIXELS):
+  """
+  Resize a pyramid level to size by reading it in horizontal strips.
+  Peak memory is one strip plus the output image, whatever the slide size.
+
+  Args:
+    slide: OpenSlide object.
+    le: Pyramid level to read.
+    size: (width, height) of the output image.
+    max_pixels: Maximum number of level pixels to read per strip.
+  Returns:
+    The resized level as an RGB PIL image.
+  """
+  n_w, n_h = size
+  l_w, l_h = slide.level_dimensions[le]
+  ds = slide.level_downsamples[le]
+  fy = l_h / n_h
+
+  # Output rows per strip, strips overlap by pad rows to feed the filter
+  step = max(1, int(max_pixels // (l_w * fy)))
+  pad = int(math.ceil(fy)) + 1
+  out = np.zeros((n_h, n_w, 3), dtype=np.uint8)
+  m = mt.get()
+
+  for r0 in range(0, n_h, step):
+    r1 = min(r0 + step, n_h)
+    y0 = max(0, int(math.floor(r0 * fy)) - pad)
+    y1 = min(l_h, int(math.ceil(r1 * fy)) + pad)
+
+    with m.stage("slide_read"):
+      strip = slide.read_region((0, int(round(y0 * ds))), le, (l_w, y1 - y0))
+      strip = strip.convert("RGB")
+
+    with m.stage("resize"):
+      box = (0, r0 * fy - y0, l_w, r1 * fy - y0)
+      out[r0:r1] = util.pil_to_np_rgb(strip.resize((n_w, r1 - r0), PIL.Image.BILINEAR, box=box))
+    del strip
+
+  return PIL.Image.fromarray(out)
+
+
+def read_tiles(hzl, level, idx, t, threshold, score=False):
+  """
+  Read a chunk of DeepZoom tiles and measure their tissue percentage in one pass.
+
+  Args:
+    hzl: DeepZoomGenerator of the slide.
+    level: DeepZoom level to read from.
+    idx: List of (col, row) tiles.
+    t: Size of the tiles.
+    threshold: Tissue percentage threshold.
+    score: Also score the tiles that pass the threshold.
+  Returns:
+    List of (x, y, tp, np_img, scores) per tile, np_img is None if the tile is
+    rejected and scores is None unless score is True.
+  """
+  m = mt.get()
+  out = []
+  full = []
+  with m.stage("tile_read"):
+    for i in idx:
+      s2n = hzl.get_tile(level, i)
+      x, y = hzl.get_tile_coordinates(level, i)[0]
+      out.append([x, y, 0, None, None])
+
+      if s2n.size[0] == t and s2n.size[1] == t:
+        full.append((len(out) - 1, util.pil_to_np_rgb(s2n)))
+
+  m.count("tiles_read", len(idx))
+  if not full:
+    m.count("tiles_rejected", len(idx))
+    return out
+
+  with m.stage("gray_filter"):
+    stack = np.stack([f[1] for f in full])
+    tps = filter.tissue_fraction(stack) * 100
+    keep = np.flatnonzero(tps >= threshold)
+  m.count("tiles_rejected", len(idx) - len(keep))
+
+  if score and len(keep):
+    with m.stage("score"):
+      scores = stain.score_tiles(stack[keep], tps[keep])
+    m.count("tiles_scored", len(keep))
+
+  for j, f in enumerate(full):
+    out[f[0]][2] = tps[j]
+
+  # Copies, a view would keep the whole stack alive as long as any of its tiles is held
+  for k, j in enumerate(keep):
+    o = out[full[j][0]]
+    o[3] = stack[j].copy()
+    if score:
+      o[4] = tuple(f[k] for f in scores)
+
+  return out
+
+
+def best_tiles(tiles, n, grid=None):
+  """
+  Keep the n highest scoring tiles of a stream with a bounded heap.
+  With grid, the level is split into about n spatial strata and only the best
+  tile of each stratum competes for the n places. Strata on glass give no
+  tile, so the places left are filled with the best runners-up of any stratum
+  and min(n, candidates) tiles are kept either way.
+
+  Args:
+    tiles: Iterable of ((col, row), (x, y, tp, np_img, scores)) as given by read_tiles().
+    n: Number of tiles to keep.
+    grid: (cols, rows) of the level for stratified selection, None for plain top-n.
+  Returns:
+    List of the kept ((col, row), (x, y, tp, np_img, scores)) in grid order.
+  """
+  heaps = {}
+  # Best n tiles that lost their stratum, only used with grid
+  rest = []
+  cap = n if grid is None else 1
+  g = int(math.ceil(math.sqrt(n)))
+
+  for k, (idx, tile) in enumerate(tiles):
+    if tile[3] is None:
+      continue
+
+    key = 0 if grid is None else (idx[0] * g // grid[0], idx[1] * g // grid[1])
+    heap = heaps.setdefault(key, [])
+    # Ties go to the tile seen first
+    item = (tile[4][0], -k, idx, tile)
+
+    if len(heap) < cap:
+      heapq.heappush(heap, item)
+      continue
+    if item > heap[0]:
+      item = heapq.heapreplace(heap, item)
+
+    if grid is None:
+      continue
+    if len(rest) < n:
+      heapq.heappush(rest, item)
+    elif item > rest[0]:
+      heapq.heapreplace(rest, item)
+
+  kept = heapq.nlargest(n, (i for h in heaps.values() for i in h))
+  kept += heapq.nlargest(n - len(kept), rest)
+  return [(i[2], i[3]) for i in sorted(kept, key=lambda i: -i[1])]
+
+
+def _zoom_worker_init(x, t, cfg=None):
+  """
+  Open a private slide handle and metrics in each extraction worker.
+  """
+  _ZOOM["slide"] = op.open_slide(x)
+  _ZOOM["hzl"] = DeepZoomGenerator(_ZOOM["slide"], t, overlap=0)
+  mt.configure(**(cfg or {}))
+  return
+
+
+def _zoom_worker_tiles(idx, level, t, threshold):
+  """
+  Read a chunk of tiles, with the metrics gathered since the last chunk.
+  """
+  out = read_tiles(_ZOOM["hzl"], level, idx, t, threshold, score=True)
+  m = mt.get()
+  return out, (m.snapshot(reset=True) if m.enabled else None)
+
+
+def _merged(results):
+  """
+  Merge the worker metrics into this process and pass the tiles on.
+  """
+  m = mt.get()
+  for out, snap in results:
+    m.merge(snap)
+    yield out
+
+
 class Slide:
   """
   Class for handling slides.
@@ -55,8 +294,11 @@ class Slide:
       self.__save_n = None
       self.__save_fn = None
       self.__scores = []
-      self.__heatmap = pd.DataFrame()
+      self.__heatmap = None
+      self.__heat_grid = None
       self.__combined_dim = None
+      self.__writer = None
+      self.__sat = None
 
   def __str__(self):
       return "Slide class for holding and processing slides."
@@ -140,10 +382,7 @@ class Slide:
               o_w, o_h = self.__slide.dimensions
               n_w, n_h = math.floor(o_w / s), math.floor(o_h / s)
               le = self.__slide.get_best_level_for_downsample(s)
-              wsi = self.__slide.read_region((0, 0), le, self.__slide.level_dimensions[le])
-
-              wsi = wsi.convert("RGB")
-              s2i = wsi.resize((n_w, n_h), PIL.Image.BILINEAR)
+              s2i = read_scaled(self.__slide, le, (n_w, n_h))
 
           else:
               o_w, o_h = self.__image.size
@@ -159,18 +398,14 @@ class Slide:
       return
 
 
-  def __get_zoom(self, t=300, mx=10, threshold=90, sample=0.5, n=50, heat=False):
+  def __get_zoom(self, t=300, mx=10, threshold=90, sample=0.5, n=50, heat=False, plan=True,
+                 workers=1, select="sample", heat_csv=False, write_threads=4, out="jpeg", mask=None):
       """
       Convert OpenSlide object to a scaled image.
       See fit() for the arguments.
       Note that this function need to default at some n number to avoid waste.
 
       """
-      loc_out = []
-      size_out = []
-      lev_out = []
-      heat_value = []
-
       # Highest zoom
       hzl = op.deepzoom.DeepZoomGenerator(self.__slide, t, overlap=0)
       gen_hz = hzl.level_count - 1
@@ -193,7 +428,7 @@ class Slide:
           self.__save_fn = (os.path.basename(self.x) + ".w" +
                             str(self.__combined_dim[0]) + ".h" +
                             str(self.__combined_dim[1]) +
-                            "heatmap.csv")
+                            "heatmap")
 
       except IndexError:
           print("ERROR : mx argument is larger than the maximum mag for slide")
@@ -202,61 +437,181 @@ class Slide:
 
       index = [(c, r) for c in range(cols) for r in range(rows)]
       mms = n
+      m = mt.get()
+
+      if plan or heat:
+          # Tissue of any window is then a lookup, the table is kept for later sweeps
+          with m.stage("plan"):
+              self.__sat = self.__tissue_index(mask)
+              self.__sat.save(os.path.join(self.__save_n, os.path.basename(self.x) + SAT_SUFFIX))
+              grid = tissue_grid(self.__sat, hzl, level, t)
+
+      if plan and not heat:
+          # Skip background tiles without decoding them
+          n_all = len(index)
+          index = plan_tiles(grid, threshold)
+          m.count("tiles_planned_out", n_all - len(index))
+          print("Planning kept {} of {} tiles".format(len(index), n_all))
+
+      pool = None
+      chunk = 16
+      if workers > 1 and not heat:
+          pool = mp.Pool(workers, initializer=_zoom_worker_init, initargs=(self.x, t, m.config()))
+          chunk = max(1, min(16, len(index) // (workers * 4)))
 
-      if heat:
-          for i in range(len(index)):
-              s2n = hzl.get_tile(level, index[i])
-
-              coo = hzl.get_tile_coordinates(level, index[i])
-              loc_out.append("x"+str(coo[0][0]) + ".y"+str(coo[0][1]))
-              lev_out.append(coo[1])
-              size_out.append("w"+str(coo[2][0]) + ".h"+str(coo[2][1]))
-              heat_value.append(heatmap_value(s2n))
-
-          self.__heatmap["Tile"] = index
-          self.__heatmap["Location"] = loc_out
-          self.__heatmap["Size"] = size_out
-          self.__heatmap["Level"] = lev_out
-          self.__heatmap["Value"] = heat_value
+      try:
+          # Tiles are encoded and written in the background as they are kept. A heatmap
+          # run writes no tile, and a ShardWriter would delete the shards of an earlier run
+          if heat:
+              writer = contextlib.nullcontext()
+          elif out == "tar":
+              writer = ShardWriter(self.__save_n, threads=write_threads)
+          else:
+              writer = TileWriter(threads=write_threads)
+
+          with writer as self.__writer:
+              if heat:
+                  # Heatmap from the tissue mask, no tile is decoded
+                  self.__heat_grid = {"value": grid.T.astype(np.float32),
+                                      "tile": t,
+                                      "level": level,
+                                      "downsample": float(2 ** (hzl.level_count - 1 - level)),
+                                      "level_dimensions": np.array(self.__combined_dim),
+                                      "dimensions": np.array(self.__slide.dimensions)}
+
+                  if heat_csv:
+                      coo = [hzl.get_tile_coordinates(level, i) for i in index]
+                      self.__heatmap = pd.DataFrame()
+                      self.__heatmap["Tile"] = index
+                      self.__heatmap["Location"] = ["x"+str(c[0][0]) + ".y"+str(c[0][1]) for c in coo]
+                      self.__heatmap["Size"] = ["w"+str(c[2][0]) + ".h"+str(c[2][1]) for c in coo]
+                      self.__heatmap["Level"] = [c[1] for c in coo]
+                      self.__heatmap["Value"] = [grid[i] for i in index]
 
-      else:
-          for i in range(len(index)):
-              if mms !=0:
-                  s2n = hzl.get_tile(level, index[i])
-                  x, y = hzl.get_tile_coordinates(level, index[i])[0]
+              else:
+                  # Workers read, filter and score; sampling stays here so the
+                  # random draws happen in the same order as the serial path
+                  parts = [index[i:i + chunk] for i in range(0, len(index), chunk)]
+                  ranked = select != "sample"
+                  if pool is None:
+                      tiles = (r for p in parts for r in read_tiles(hzl, level, p, t, threshold, score=ranked))
+                  else:
+                      tiles = (r for rs in _merged(pool.imap(functools.partial(
+                                  _zoom_worker_tiles, level=level, t=t, threshold=threshold), parts))
+                               for r in rs)
+
+                  if ranked:
+                      # Every candidate is scored, only the winners are encoded
+                      grid = (cols, rows) if select == "stratified" else None
+                      kept = [(os.path.basename(self.x) + ".x" + str(x) + ".y" + str(y) + ".jpg",
+                               np_img, tp, scores, dict(x=x, y=y, level=level))
+                              for _, (x, y, tp, np_img, scores) in best_tiles(zip(index, tiles), n, grid)]
+                      print("ALERT: iwspp kept the {} best of the requested {} tiles".format(len(kept), n))
+
+                      for k in range(0, len(kept), stain.SCORE_CHUNK):
+                          self.__keep_tiles(kept[k:k + stain.SCORE_CHUNK])
+
+                  else:
+                      kept = []
+                      for x, y, tp, np_img, scores in tiles:
+                          if mms == 0:
+                              print("ALERT: iwspp got the requested {} tiles".format(n))
+                              break
+
+                          if np_img is not None:
+                              sp = np.random.choice((1, 0), p=[sample, 1 - sample])
+
+                              if sp == 1:
+                                  mms -= 1
+                                  f_n = (os.path.basename(self.x) + ".x" + str(x) + ".y" + str(y) + ".jpg")
+                                  kept.append((f_n, np_img, tp, scores, dict(x=x, y=y, level=level)))
+
+                                  if len(kept) == stain.SCORE_CHUNK:
+                                      self.__keep_tiles(kept)
+                                      kept = []
+
+                      self.__keep_tiles(kept)
+
+      finally:
+          if pool is not None:
+              pool.terminate()
+              pool.join()
+
+      if not heat:
+          self.__writer.report()
+      return
 
-                  if s2n.size[0] == t and s2n.size[1] == t:
-                      np_img = util.pil_to_np_rgb(s2n)
-                      mask_not_gray = filter.filter_grays(np_img)
-                      rgb_not_gray = util.mask_rgb(np_img, mask_not_gray)
-                      tp = filter.tissue_percent(rgb_not_gray)
+  def __tissue_index(self, mask):
+      """
+      Summed-area table of the slide tissue, from a saved tissue mask when there
+      is one, else from the scaled image.
 
-                      if tp >= threshold:
-                          sp = np.random.choice((1, 0), p=[sample, 1 - sample])
+      Args:
+          mask: TissueMask, path to one (see segment.segment_slide) or None.
+      """
+      if mask is None:
+          return tissue_index(self.__scaled["np_image"], self.__slide.dimensions)
+      if not isinstance(mask, TissueMask):
+          mask = TissueMask(mask)
+      return SummedAreaTable.from_tissue_mask(mask)
 
-                          if sp == 1:
-                              mms -= 1
-                              score, _, _, qun_factor = stain.score_tile(np_img, tp)
+  def tissue_fractions(self, x, y, w, h):
+      """
+      Tissue fraction (0-1) of windows in level 0 pixels, vectorized, from the
+      summed-area table built by fit() (also saved as <slide>.sat.npz).
 
-                              f_n = (os.path.basename(self.x) + ".x" + str(x) + ".y" + str(y) + ".jpg")
-                              self.__scores.append((score, qun_factor))
-                              s2n.save(os.path.join(self.__save_n, f_n), "JPEG")
+      Args:
+          x: Left of the windows, number or NumPy array.
+          y: Top of the windows.
+          w: Width of the windows.
+          h: Height of the windows.
+      """
+      if self.__sat is None:
+          print("ERROR: Please, fit the class first before using this code.")
+          return None
+      return self.__sat.fractions(x, y, w, h)
 
-              else:
-                  print("ALERT: iwspp got the requested {} tiles".format(n))
-                  break
+  def __keep_tiles(self, kept):
+      """
+      Score a chunk of sampled tiles that have no scores yet and save them.
 
+      Args:
+          kept: List of (file name, tile, tissue percentage, scores or None, location).
+      """
+      m = mt.get()
+      todo = [k for k, v in enumerate(kept) if v[3] is None]
+      if todo:
+          with m.stage("score"):
+              scores = stain.score_tiles(np.stack([kept[k][1] for k in todo]),
+                                         [kept[k][2] for k in todo])
+          m.count("tiles_scored", len(todo))
+          for j, k in enumerate(todo):
+              kept[k] = kept[k][:3] + (tuple(f[j] for f in scores),) + kept[k][4:]
+
+      for f_n, np_img, tp, scores, loc in kept:
+          score, color_factor, s_and_v_factor, qun_factor = scores
+          self.__scores.append((score, qun_factor))
+          meta = dict(slide=os.path.basename(self.x), tissue_percent=tp, score=score,
+                      color_factor=color_factor, s_and_v_factor=s_and_v_factor,
+                      quantity_factor=qun_factor, **loc)
+          self.__writer.submit(np_img, os.path.join(self.__save_n, f_n), meta)
+
+      m.tick()
       return
 
   def __save_heat(self):
       """
-      Save the heatmap file to disk.
-      Need a code to create colours from this file.
-      Returns:
-
+      Save the heatmap to disk as a (rows, cols) grid in a .npz file.
+      The file also holds the tile size, DeepZoom level, its downsample and
+      dimensions and the slide dimensions to place the grid on the slide.
+      The CSV version is written too when it was requested.
       """
-      self.__heatmap.to_csv(os.path.join(self.__save_n,
-                                         self.__save_fn), index=False)
+      np.savez_compressed(os.path.join(self.__save_n, self.__save_fn + ".npz"),
+                          **self.__heat_grid)
+
+      if self.__heatmap is not None:
+          self.__heatmap.to_csv(os.path.join(self.__save_n,
+                                             self.__save_fn + ".csv"), index=False)
       return
 
 
@@ -272,7 +627,8 @@ class Slide:
           self.__scaled["image"].show()
       return
 
-  def fit(self, s=32, t=300, mx=5, threshold=85, sample=0.4, n=20, heat=False):
+  def fit(self, s=32, t=300, mx=5, threshold=85, sample=0.4, n=20, heat=False, plan=True,
+          workers=1, select="sample", heat_csv=False, write_threads=4, out="jpeg", mask=None):
       """
       Fit the class.
       Args:
@@ -283,12 +639,29 @@ class Slide:
           sample: Probability of sampling s valid tile (0-1).
           n: Maximum number of tiles to get per slide.
           heat: Indicate if heatmap is required.
+          heat_csv: Also save the heatmap as a CSV table.
+          plan: Only read tiles that the scaled image marks as tissue.
+          workers: Number of processes reading tiles, 1 reads them in this process.
+          write_threads: Number of threads encoding and writing the kept tiles.
+          out: "jpeg" writes one file per tile, "tar" appends the tiles to indexed
+               tar shards (see shard.ShardWriter).
+          select: How tiles are chosen, "sample" keeps each valid tile with probability
+                  sample until n are kept, "top" keeps the n best scoring tiles and
+                  "stratified" keeps the best tile of n spatial strata, topped up
+                  with the next best tiles when strata are empty.
+          mask: Saved tissue mask (TissueMask or its path, see segment.segment_slide) used
+                for planning and the heatmap instead of the scaled image.
       """
+      if select not in SELECT_MODES:
+          raise ValueError("select must be one of {}, not {}".format(", ".join(SELECT_MODES), select))
+
       self.__open()
       self.__slide2image(s)
       self.__get_zoom(t=t, mx=mx,
                       threshold=threshold,
-                      sample=sample, n=n, heat=heat)
+                      sample=sample, n=n, heat=heat, plan=plan,
+                      workers=workers, select=select, heat_csv=heat_csv,
+                      write_threads=write_threads, out=out, mask=mask)
 
       if heat:
           self.__save_heat()
@@ -306,14 +679,74 @@ class Slide:
         path: The path to save the image.
       """
       print("Saving to {}".format(path))
-      self.__scaled["image"].save(path, "JPEG")
+      with mt.get().stage("save_image"):
+          self.__scaled["image"].save(path, "JPEG")
       return
 
 
+def slide_cost(x, f="slide"):
+  """
+  Expected cost of converting a slide, read from the file header only.
+
+  Args:
+    x: Path to the slide or image.
+    f: Type of the input file (slide or image).
+  Returns:
+    Number of pixels at full resolution, 0 if the header cannot be read.
+  """
+  try:
+      if f == "slide":
+          sl = op.OpenSlide(x)
+          w, h = sl.level_dimensions[0]
+          sl.close()
+      else:
+          with PIL.Image.open(x) as im:
+              w, h = im.size
+
+  except (op.OpenSlideError, OSError):
+      return 0
+
+  return w * h
+
+
+def convert_slide(x, fps, f="slide", cfg=None, **kwargs):
+  """
+  Fit and save a single slide, errors are returned instead of raised.
+
+  Args:
+    x: Path to the slide.
+    fps: Path to save the converted image.
+    f: Type of the input file (slide or image).
+    cfg: Metrics settings (see metrics.Metrics.config) when running in a worker process.
+    kwargs: Arguments passed on to Slide.fit().
+  Returns:
+    Tuple of (x, error, metrics), error is None when the slide was converted and
+    metrics is the snapshot of the worker metrics, None without cfg.
+  """
+  m = mt.get() if cfg is None else mt.configure(**cfg)
+  err = None
+
+  try:
+      with m.input(x):
+          sl = Slide(x=x, f=f)
+          sl.fit(**kwargs)
+          sl.save(fps)
+
+  except (Exception, SystemExit) as e:
+      err = repr(e)
+
+  return x, err, (m.snapshot(reset=True) if cfg is not None and m.enabled else None)
+
+
 def multi_slide_to_image(path, tf=".svs", f="slide", s=64, t=300,
-                         mx=5, threshold=90, sample=0.5, n=200, heat=False):
+                         mx=5, threshold=90, sample=0.5, n=200, heat=False, workers=1,
+                         select="sample", heat_csv=False, resume=True, out="jpeg",
+                         metrics=None, profile=False, memory=False, mask=False):
   """
   Convert multiple slides to images from a folder to "converted" folder.
+  Slides are processed largest first and a failing slide does not stop the run.
+  Progress is journaled in converted/manifest.jsonl, a rerun skips the slides
+  already converted with the same parameters and redoes changed or partial ones.
 
   Args:
         path: The path to save the image
@@ -326,29 +759,76 @@ def multi_slide_to_image(path, tf=".svs", f="slide", s=64, t=300,
         sample: Probability of sampling s valid tile (0-1)
         n: Maximum number of tiles to get per slide
         heat: Indicate if heatmap is required
+        heat_csv: Also save the heatmap as a CSV table
+        workers: Number of slides to convert at the same time
+        select: Tile selection mode, "sample", "top" or "stratified" (see Slide.fit)
+        resume: Skip the slides the manifest marks as done
+        out: Tile output, "jpeg" files or "tar" shards (see Slide.fit)
+        metrics: JSON file for the per-stage timers and counters, also rewritten during the run
+        profile: Save a cProfile of every slide next to the metrics file
+        memory: Record the peak traced memory of every slide
+        mask: Plan the tiles from the masks saved by segment.multi_segment_slides in path/masks
 
   """
-  timer = Time()
+  if select not in SELECT_MODES:
+      raise ValueError("select must be one of {}, not {}".format(", ".join(SELECT_MODES), select))
+  timer = mt.start(metrics, profile=profile, memory=memory)
 
   n_path = os.path.join(path, "converted")
   if not os.path.exists(n_path):
       os.makedirs(n_path)
       print("ATTENTION: Converted files are in {}".format(n_path))
 
-  files = os.listdir(path)
-
-  for i in files:
-      if i.endswith(tf):
-          print(i)
-          sl = Slide(x=str(os.path.join(path, i)), f=f)
-          sl.fit(s=s, t=t, mx=mx, threshold=threshold,
-                 sample=sample, n=n, heat=heat)
-          # sl.info()
-          fps = os.path.join(n_path, i[:-4], (i + ".jpg"))
-          sl.save(fps)
+  files = [i for i in os.listdir(path) if i.endswith(tf)]
+  files = sorted(files, key=lambda i: slide_cost(os.path.join(path, i), f), reverse=True)
+
+  jobs = {str(os.path.join(path, i)): os.path.join(n_path, i[:-4], (i + ".jpg")) for i in files}
+  kwargs = dict(s=s, t=t, mx=mx, threshold=threshold, sample=sample, n=n, heat=heat,
+                select=select, heat_csv=heat_csv, out=out)
+  failed = []
+
+  masks = dict.fromkeys(jobs)
+  if mask:
+      masks = {x: mask_path(path, x) if os.path.exists(mask_path(path, x)) else None for x in jobs}
+      missing = [x for x in jobs if masks[x] is None]
+      if missing:
+          print("ALERT: {} slides have no tissue mask, their scaled image is used".format(len(missing)))
+
+  manifest = Manifest(n_path, dict(kwargs, f=f, mask=mask))
+  if resume:
+      finished = [x for x in jobs if manifest.done(x)]
+      if finished:
+          print("ATTENTION: Skipping {} slides converted by an earlier run".format(len(finished)))
+      jobs = {x: jobs[x] for x in jobs if x not in finished}
+
+  if workers > 1:
+      def finish(x, err, snap=None):
+          timer.merge(snap)
+          manifest.finish(x, err)
+          if err is not None:
+              failed.append((x, err))
+          print("{} {}".format(os.path.basename(x), "failed" if err else "done"))
+          timer.tick()
+
+      for x in jobs:
+          manifest.start(x, [os.path.dirname(jobs[x])])
+      # A crashed worker only fails its own slide, see manifest.run_pool
+      run_pool({x: functools.partial(convert_slide, x, jobs[x], f, timer.config(), mask=masks[x], **kwargs)
+                for x in jobs}, workers, finish)
+
+  else:
+      for x in jobs:
+          print(os.path.basename(x))
+          manifest.start(x, [os.path.dirname(jobs[x])])
+          _, err, _ = convert_slide(x, jobs[x], f, mask=masks[x], **kwargs)
+          manifest.finish(x, err)
+          if err is not None:
+              failed.append((x, err))
+
+  if failed:
+      print("ERROR: {} of {} slides failed, see failed.csv".format(len(failed), len(jobs)))
+      pd.DataFrame(failed, columns=["Slide", "Error"]).to_csv(os.path.join(n_path, "failed.csv"),
+                                                               index=False)
 
   timer.elapsed_display()
   return
-
-
-multi_slide_to_image("data/", tf=".svs", f="slide", s=32, mx=6, threshold=90, heat=False)
@@ -7,6 +7,11 @@ HSV_PURPLE = 270
 HSV_PINK = 330
 TISSUE_HIGH_THRESH = 80
 TISSUE_LOW_THRESH = 10
+SCORE_CHUNK = 32
+# Most pixels converted to HSV at a time by tile_factors(), so the intermediates stay in cache
+SCORE_PIXELS = 2 ** 16
+# Largest score difference between score_tiles() and score_tile_reference(), see tile_hsv()
+SCORE_TOLERANCE = 1e-3
 
 def rgb_to_hues(rgb):
   """
@@ -21,6 +26,40 @@ def rgb_to_hues(rgb):
   return h
 
 
+def tile_hsv(rgb):
+  """
+  Convert RGB to HSV in a single pass without float64 intermediates.
+  Hues are computed exactly in integer arithmetic and truncated to whole degrees like rgb_to_hues(), saturation and
+  value are float32. Rounding in the float64 reference can put a hue exactly on a whole degree one degree lower,
+  which moves scores by far less than SCORE_TOLERANCE.
+  Args:
+    rgb: RGB image or stack of images as a uint8 NumPy array (..., 3).
+  Returns:
+    Tuple of hue in degrees (int16), saturation (float32) and value (float32) arrays of shape rgb.shape[:-1].
+  """
+  # int16 holds every intermediate, 60 * (255 - 0) + 240 < 2 ** 15
+  r = rgb[..., 0].astype(np.int16)
+  g = rgb[..., 1].astype(np.int16)
+  b = rgb[..., 2].astype(np.int16)
+  mx = np.maximum(np.maximum(r, g), b)
+  delta = mx - np.minimum(np.minimum(r, g), b)
+
+  # When channels tie for the maximum, blue wins over green and green over red, as in skimage
+  is_b = b == mx
+  is_g = (g == mx) & ~is_b
+  hues = np.where(is_b, r - g, np.where(is_g, b - r, g - b))
+  # floor(60 * num / d) + offset is floor((60 * num + offset * d) / d), only red can go negative
+  hues *= 60
+  hues //= np.maximum(delta, 1)
+  hues += np.where(is_b, np.int16(240), np.where(is_g, np.int16(120), np.int16(0)))
+  hues[hues < 0] += 360
+  hues[delta == 0] = 0
+
+  s = np.divide(delta, mx, out=np.zeros(mx.shape, dtype=np.float32), where=mx > 0, dtype=np.float32)
+  v = mx.astype(np.float32) / np.float32(255)
+  return hues, s, v
+
+
 def hsv_purple_deviation(hsv_hues):
   """
   Obtain the deviation from the HSV hue for purple.
@@ -147,6 +186,19 @@ def tissue_quantity_factor(amount):
 def score_tile(np_tile, tissue_percent):
   """
   Score tile based on tissue percentage, color factor, saturation/value factor, and tissue quantity factor.
+  All factors come from a single tile_hsv() pass.
+  Args:
+    np_tile: Tile as NumPy array.
+    tissue_percent: The percentage of the tile judged to be tissue.
+  Returns tuple consisting of score, color factor, saturation/value factor, and tissue quantity factor.
+  """
+  scores = score_tiles(np_tile[None, :, :, :3], [tissue_percent])
+  return tuple(float(x[0]) for x in scores)
+
+
+def score_tile_reference(np_tile, tissue_percent):
+  """
+  score_tile() with two float64 HSV conversions, one per factor. Slow, kept to check the fast path against.
   Args:
     np_tile: Tile as NumPy array.
     tissue_percent: The percentage of the tile judged to be tissue.
@@ -161,3 +213,142 @@ def score_tile(np_tile, tissue_percent):
   # scale score to between 0 and 1
   score = 1.0 - (10.0 / (10.0 + score))
   return score, color_factor, s_and_v_factor, quantity_factor
+
+
+def hue_histograms(hues):
+  """
+  Integer hue histogram (0-359 degrees) of every tile. Histograms add up, so the sum over the tiles of a slide is
+  the histogram of the slide.
+  Args:
+    hues: Hues in whole degrees as an (N, P) integer NumPy array, see tile_hsv().
+  Returns:
+    (N, 360) int64 NumPy array of pixel counts per degree.
+  """
+  n = hues.shape[0]
+  offset = (np.arange(n, dtype=np.int64) * 360)[:, None]
+  return np.bincount((hues + offset).ravel(), minlength=n * 360).reshape(n, 360)
+
+
+def hue_moments(hist, low=260, high=340):
+  """
+  Pixel count, mean hue and second moment of the hues in [low, high] from hue histograms, in O(bins).
+  Args:
+    hist: Hue histogram (360,) or histograms (N, 360), see hue_histograms().
+    low: Lowest hue of the window.
+    high: Highest hue of the window.
+  Returns:
+    Tuple of count, mean and mean square of the window hues, 0 where the window is empty.
+  """
+  window = np.asarray(hist)[..., low:high + 1].astype(np.float64)
+  k = np.arange(low, high + 1, dtype=np.float64)
+  count = window.sum(axis=-1)
+  safe = np.maximum(count, 1)
+  return count, window @ k / safe, window @ (k ** 2) / safe
+
+
+def histogram_purple_pink_factor(hist, purple=HSV_PURPLE, pink=HSV_PINK, low=260, high=340):
+  """
+  hsv_purple_pink_factor() from hue histograms, so tiles or whole slides can be scored again with other target
+  hues without their pixels.
+  Args:
+    hist: Hue histogram (360,) or histograms (N, 360), see hue_histograms().
+    purple: Target hue of hematoxylin.
+    pink: Target hue of eosin.
+    low: Lowest hue of the purple to pink window.
+    high: Highest hue of the purple to pink window.
+  Returns:
+    Color factor, one per histogram.
+  """
+  count, mean, square = hue_moments(hist, low, high)
+
+  # Mean square deviation from a target t is E[h^2] - 2 t E[h] + t^2
+  pu_dev = np.sqrt(np.maximum(square - 2 * purple * mean + purple ** 2, 0))
+  pi_dev = np.sqrt(np.maximum(square - 2 * pink * mean + pink ** 2, 0))
+  avg_factor = (high - mean) ** 2
+  return np.where((count > 0) & (pu_dev != 0), pi_dev / np.where(pu_dev == 0, 1, pu_dev) * avg_factor, 0)
+
+
+def hue_summary(hist, purple=HSV_PURPLE, pink=HSV_PINK, low=260, high=340):
+  """
+  Color summary of a hue histogram, for example the sum of the histograms of every tile of a slide.
+  Args:
+    hist: Hue histogram (360,).
+    purple: Target hue of hematoxylin.
+    pink: Target hue of eosin.
+    low: Lowest hue of the purple to pink window.
+    high: Highest hue of the purple to pink window.
+  Returns:
+    Dictionary of pixel count, window fraction, window mean hue and color factor.
+  """
+  hist = np.asarray(hist)
+  count, mean, _ = hue_moments(hist, low, high)
+  return dict(pixels=int(hist.sum()), window_fraction=float(count / max(1, hist.sum())),
+              mean_hue=float(mean),
+              color_factor=float(histogram_purple_pink_factor(hist, purple, pink, low, high)))
+
+
+def tile_factors(np_stack):
+  """
+  Hue histograms and saturation/value factors of a stack of tiles, all the pixel work of score_tiles().
+  Tiles go through tile_hsv() in groups of about SCORE_PIXELS pixels, one at a time for large tiles, as
+  the intermediates of a whole stack do not fit in cache and convert slower than tile by tile.
+  Args:
+    np_stack: Tiles as a (N, H, W, 3) uint8 NumPy array.
+  Returns:
+    Tuple of (N, 360) hue histograms and (N,) saturation/value factors.
+  """
+  n, h, w, _ = np_stack.shape
+  step = max(1, SCORE_PIXELS // (h * w))
+  hist = np.zeros((n, 360), dtype=np.int64)
+  s_std = np.zeros(n, dtype=np.float32)
+  v_std = np.zeros(n, dtype=np.float32)
+
+  for k in range(0, n, step):
+    hues, s, v = tile_hsv(np_stack[k:k + step, :, :, :3].reshape(-1, h * w, 3))
+    hist[k:k + step] = hue_histograms(hues)
+    s_std[k:k + step] = np.std(s, axis=1)
+    v_std[k:k + step] = np.std(v, axis=1)
+
+  s_low = s_std < 0.05
+  v_low = v_std < 0.05
+  s_and_v_factor = np.select([s_low & v_low, s_low | v_low], [0.4, 0.7], 1) ** 2
+  return hist, s_and_v_factor
+
+
+def score_histograms(hist, s_and_v_factor, tissue_percents, purple=HSV_PURPLE, pink=HSV_PINK):
+  """
+  Score tiles from their hue histograms and saturation/value factors, see tile_factors().
+  Args:
+    hist: Hue histograms (N, 360).
+    s_and_v_factor: Saturation/value factors (N,).
+    tissue_percents: The percentage of each tile judged to be tissue, shape (N,).
+    purple: Target hue of hematoxylin.
+    pink: Target hue of eosin.
+  Returns tuple of (N,) arrays: score, color factor, saturation/value factor, and tissue quantity factor.
+  """
+  tissue_percents = np.asarray(tissue_percents, dtype=np.float64)
+  color_factor = histogram_purple_pink_factor(hist, purple, pink)
+
+  # Quantity factor
+  quantity_factor = np.select([tissue_percents >= TISSUE_HIGH_THRESH,
+                               tissue_percents >= TISSUE_LOW_THRESH,
+                               tissue_percents > 0], [1.0, 0.2, 0.1], 0.0)
+
+  combined_factor = color_factor * s_and_v_factor * quantity_factor
+  score = (tissue_percents ** 2) * np.log(1 + combined_factor) / 1000.0
+  score = 1.0 - (10.0 / (10.0 + score))
+  return score, color_factor, s_and_v_factor, quantity_factor
+
+
+def score_tiles(np_stack, tissue_percents, purple=HSV_PURPLE, pink=HSV_PINK):
+  """
+  Vectorized score_tile() for a stack of tiles of the same size.
+  Args:
+    np_stack: Tiles as a (N, H, W, 3) uint8 NumPy array.
+    tissue_percents: The percentage of each tile judged to be tissue, shape (N,).
+    purple: Target hue of hematoxylin.
+    pink: Target hue of eosin.
+  Returns tuple of (N,) arrays: score, color factor, saturation/value factor, and tissue quantity factor.
+  """
+  hist, s_and_v_factor = tile_factors(np_stack)
+  return score_histograms(hist, s_and_v_factor, tissue_percents, purple, pink)
@@ -0,0 +1,22 @@
+"""
+Name: tilename
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import re
+
+# Tile file names of Slide (<slide>.x0.y300.jpg) and Tile (<image>_slice_01_02.jpg)
+TILE_NAME = re.compile(r"^(.*?)(?:\.x\d+\.y\d+|_slice_\d+_\d+)\.\w+$")
+
+
+def slide_key(name):
+    """
+    Get the slide a tile or image file belongs to from its name.
+    Files that are not tiles, like the scaled image of a slide, are their own slide.
+
+    Args:
+        name: File name.
+    """
+    found = TILE_NAME.match(os.path.basename(name))
+    return found.group(1) if found else os.path.splitext(os.path.basename(name))[0]
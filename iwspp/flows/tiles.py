@@ -3,15 +3,96 @@ Name: slide
 Author: Chinedu A. Anene, Phd
 """
 
-import image_slicer as ims
 import os
-import copy
+import math
+import cv2 as cv
+import numpy as np
 import pandas as pd
-from PIL import ImageOps, ImageDraw
+from PIL import ImageDraw
 from iwspp.flows import util, stain, filter
 from PIL import Image
-from iwspp.flows.util import Time
+from iwspp.flows import metrics as mt
+from iwspp.flows.manifest import Manifest
+from iwspp.flows.writer import TileWriter
+from iwspp.flows.shard import ShardWriter
+from iwspp.flows.sat import SummedAreaTable, SAT_SUFFIX
 
+# Width in pixels of a character of the default PIL font
+LABEL_CHAR = 6
+
+
+def auto_grid(w, h):
+  """
+  Default grid of an image, about 10 tiles per 1041 pixels along each side.
+
+  Args:
+    w: Width of the image.
+    h: Height of the image.
+  Returns:
+    Tuple of (width, height) of the tiles and (columns, rows) of the grid.
+  """
+  n = max(2, (w * 10 // 1041) * (h * 10 // 1041))
+  cols = int(math.ceil(math.sqrt(n)))
+  rows = int(math.ceil(n / float(cols)))
+  return (w // cols, h // rows), (cols, rows)
+
+
+def tile_views(np_img, size, stride=None):
+  """
+  Tiles of an image as strided views, no pixel is copied.
+  Only whole tiles are returned, the right and bottom remainders are dropped.
+
+  Args:
+    np_img: Image as an (H, W, C) NumPy array.
+    size: (width, height) of the tiles in pixels.
+    stride: (x, y) distance between tiles, size by default, smaller for overlapping tiles.
+  Returns:
+    (rows, cols, height, width, C) view of the tiles.
+  """
+  tw, th = size
+  sx, sy = size if stride is None else stride
+  win = np.lib.stride_tricks.sliding_window_view(np_img, (th, tw), axis=(0, 1))
+  return np.moveaxis(win[::sy, ::sx], 2, -1)
+
+
+def annotation_mosaic(np_img, xs, ys, size, selected, labels, scale=0.25):
+  """
+  Downsampled image with the tile grid drawn on it, green for the selected tiles and white for the rest.
+  Only the reduced image is allocated, the grid and labels are drawn at the reduced scale.
+
+  Args:
+    np_img: Image as an (H, W, 3) NumPy array.
+    xs: Left of each tile in image pixels.
+    ys: Top of each tile.
+    size: (width, height) of the tiles.
+    selected: Flag of each tile, True if it was selected.
+    labels: Text of each tile.
+    scale: Size of the mosaic relative to the image, labels that do not fit a reduced tile are left out.
+  Returns:
+    The mosaic as an RGB PIL image.
+  """
+  tw, th = size
+  w, h = int(max(xs)) + tw, int(max(ys)) + th
+  out_w, out_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+  ann = Image.fromarray(cv.resize(np_img[:h, :w], (out_w, out_h), interpolation=cv.INTER_AREA))
+
+  draw = ImageDraw.Draw(ann)
+  fx, fy = out_w / float(w), out_h / float(h)
+  sw, sh = tw * fx, th * fy
+  line = max(1, int(round(2 * scale)))
+
+  # Rejected tiles first so the selected outlines stay on top where tiles overlap
+  for sel in (False, True):
+    color = "green" if sel else "white"
+    for x, y, flag, text in zip(xs, ys, selected, labels):
+      if bool(flag) != sel:
+        continue
+      x0, y0 = x * fx, y * fy
+      draw.rectangle([x0, y0, x0 + sw, y0 + sh], outline=color, width=line)
+      if LABEL_CHAR * len(text) <= sw - 2 * line:
+        draw.text((x0 + line, y0 + line), text, fill=color)
+
+  return ann
 
 
 class Tile:
@@ -20,7 +101,7 @@ class Tile:
   Note: Expects images (JPEG, PNG, etc)
   """
 
-  def __init__(self, x, o, t=80, sa=False):
+  def __init__(self, x, o, t=80, sa=False, threads=4, out="jpeg", size=None, stride=None, ann_scale=0.25):
       """
       Slide class.
 
@@ -29,14 +110,27 @@ class Tile:
           o: Output path
           t: Content threshold
           sa: Save all tiles (not recommended)
+          threads: Number of threads encoding and writing tiles
+          out: "jpeg" writes one file per tile, "tar" appends them to indexed tar shards
+          size: Tile size in pixels, a number or (width, height), None splits the image in about
+                10 tiles per 1041 pixels along each side
+          stride: Distance between tiles in pixels, a number or (x, y), size by default, smaller for overlap
+          ann_scale: Size of annotation.jpg relative to the image, 0 or None skips it
       """
       self.x = x
       self.o = o
       self.t = t
       self.sa = sa
+      self.threads = threads
+      self.out = out
+      self.size = size
+      self.stride = stride
+      self.ann_scale = ann_scale
       self.__loaded = 0
-      self.__tile = None
+      self.__np_img = None
       self.__image = None
+      self.__xs = None
+      self.__ys = None
       self.__bn = os.path.basename(x[:-4])
       self.__np = os.path.join(o, self.__bn, "selectedTile")
       self.__np2 = os.path.join(o, self.__bn, "allTile")
@@ -51,26 +145,35 @@ class Tile:
 
   def __open(self):
       """
-      Get image and the associated tiles.
-      Note : N is proportional to the image size
+      Decode the image once and get its tiles as views of it.
       """
 
       if not os.path.exists(self.__np):
           os.makedirs(self.__np)
 
-      try:
-          rs, cs = Image.open(self.x).size
-          rts = rs * 10 // 1041
-          cts = cs * 10 // 1041
-          self.__tile = int(rts * cts)
+      with mt.get().stage("split"):
+          try:
+              self.__np_img = util.pil_to_np_rgb(Image.open(self.x).convert("RGB"))
 
-      except FileNotFoundError:
-          print("Ensure you give the full path of the folder.")
+          except FileNotFoundError:
+              print("Ensure you give the full path of the folder.")
+              raise
 
-      if self.__tile < 2:
-          self.__tile = 2
+          h, w = self.__np_img.shape[:2]
+          if self.size is None:
+              size, (cols, rows) = auto_grid(w, h)
+              stride = size
+          else:
+              size = (self.size, self.size) if np.ndim(self.size) == 0 else tuple(self.size)
+              stride = size if self.stride is None else self.stride
+              stride = (stride, stride) if np.ndim(stride) == 0 else tuple(stride)
+              if size[0] > w or size[1] > h:
+                  raise ValueError("tile size {} is larger than the image {}".format(size, (w, h)))
+              cols, rows = (w - size[0]) // stride[0] + 1, (h - size[1]) // stride[1] + 1
 
-      self.__image = ims.slice(self.x, self.__tile, save=False)
+          self.__image = tile_views(self.__np_img, size, stride)[:rows, :cols]
+          self.__xs = np.arange(cols) * stride[0]
+          self.__ys = np.arange(rows) * stride[1]
 
       self.__loaded = 1
       return
@@ -79,77 +182,106 @@ class Tile:
   def __gettile(self):
       """
       Obtain content rich slices and create annotation tile.
+      Tiles are views of the decoded image, only the saved ones are copied for encoding.
 
       """
 
-      s_tiles = list(copy.deepcopy(self.__image))
+      rows, cols = self.__image.shape[:2]
+      th, tw = self.__image.shape[2:4]
+      grid = [(r, c) for r in range(rows) for c in range(cols)]
+      xs = np.array([self.__xs[c] for r, c in grid])
+      ys = np.array([self.__ys[r] for r, c in grid])
 
-      l_tiles = list()
       tile_name = []
       s_score = []
       s_color_factor = []
       s_s_and_v_factor = []
       s_quantity_factor = []
 
-      if self.sa:
-          # Save everything no checks
-          if not os.path.exists(self.__np2):
-              os.makedirs(self.__np2)
-          ims.save_tiles(self.__image, directory=self.__np2,
-                         prefix=self.__bn + "_slice", format="JPEG")
-
-      for i in range(len(self.__image)):
-          t_n = "0" + str(self.__image[i].column) + "_0" + str(self.__image[i].row)
-          pil_img = self.__image[i].image
-          np_img = util.pil_to_np_rgb(pil_img)
-          tp = filter.tissue_percent(np_img)
-
-          if tp >= self.t:
-              l_tiles.append(self.__image[i])
-
-              # Score
-              score, color_factor, s_and_v_factor, quantity_factor = stain.score_tile(np_img, tp)
-              tile_name.append(self.__bn + "_slice_0" + str(self.__image[i].column) + "_0"
-                               + str(self.__image[i].row) + ".jpg")
-
+      # Tiles are encoded and written in the background
+      with self.__writer(self.__np) as writer:
+          if self.sa:
+              # Save everything no checks
+              with self.__writer(self.__np2) as all_writer:
+                  for i, (r, c) in enumerate(grid):
+                      all_writer.submit(np.ascontiguousarray(self.__image[r, c]),
+                                        os.path.join(self.__np2, self.__name(r, c)),
+                                        dict(slide=self.__bn, x=int(xs[i]), y=int(ys[i]), level=0))
+
+          # Tissue check, then score the passing tiles in chunks
+          m = mt.get()
+          with m.stage("gray_filter"):
+              # One mask and summed-area table for the image, each tile is then four lookups
+              sat = SummedAreaTable(filter.tissue_mask(self.__np_img))
+              sat.save(os.path.join(self.o, self.__bn, self.__bn + SAT_SUFFIX))
+              tps = 100 * sat.fractions(xs, ys, tw, th)
+              keep = np.flatnonzero(tps >= self.t)
+          m.count("tiles_read", len(grid))
+          m.count("tiles_rejected", len(grid) - len(keep))
+          scores = {}
+
+          for k in range(0, len(keep), stain.SCORE_CHUNK):
+              part = keep[k:k + stain.SCORE_CHUNK]
+              with m.stage("score"):
+                  stack = self.__image[[grid[i][0] for i in part], [grid[i][1] for i in part]]
+                  chunk_scores = stain.score_tiles(stack, tps[part])
+              for j, i in enumerate(part):
+                  scores[i] = tuple(f[j] for f in chunk_scores)
+          m.count("tiles_scored", len(keep))
+
+          for i in keep:
+              r, c = grid[i]
+              name = self.__name(r, c)
+              score, color_factor, s_and_v_factor, quantity_factor = scores[i]
+              writer.submit(np.ascontiguousarray(self.__image[r, c]), os.path.join(self.__np, name),
+                            dict(slide=self.__bn, x=int(xs[i]), y=int(ys[i]), level=0,
+                                 tissue_percent=tps[i], score=score, color_factor=color_factor,
+                                 s_and_v_factor=s_and_v_factor, quantity_factor=quantity_factor))
+              tile_name.append(name)
               s_score.append(score)
               s_color_factor.append(color_factor)
               s_s_and_v_factor.append(s_and_v_factor)
               s_quantity_factor.append(quantity_factor)
 
-              # Annotate
-              pil_img_exp = ImageOps.expand(pil_img, border=2, fill="green")
-              draw = ImageDraw.Draw(pil_img_exp)
-              draw.text((0, 0), t_n, fill="green")
-              s_tiles[i].image = pil_img_exp
-
-          else:
-              pil_img_exp = ImageOps.expand(pil_img, border=2, fill="white")
-              draw = ImageDraw.Draw(pil_img_exp)
-              draw.text((0, 0), t_n, fill="white")
-              s_tiles[i].image = pil_img_exp
-
-      # Join
-      s_tiles = ims.join(s_tiles)
-      s_tiles = s_tiles.convert("RGB")
-      s_tiles.save(fp=os.path.join(self.__np, "annotation.jpg"))
-
-      # Table
-      self.__tab_out["Name"] = tile_name
-      self.__tab_out["score"] = s_score
-      self.__tab_out["color_factor"] = s_color_factor
-      self.__tab_out["s_and_v_factor"] = s_s_and_v_factor
-      self.__tab_out["quantity_factor"] = s_quantity_factor
-      self.__tab_out["source"] = self.__np
-
-      self.__tab_out.to_csv(os.path.join(self.__np, "annotation.csv"), index=False)
-
-      # Save
-      ims.save_tiles(l_tiles, directory=self.__np,
-                              prefix=self.__bn + "_slice", format="JPEG")
+          # Annotate, green for the selected tiles and white for the rest
+          if self.ann_scale:
+              with m.stage("annotation"):
+                  selected = np.zeros(len(grid), dtype=bool)
+                  selected[keep] = True
+                  ann = annotation_mosaic(self.__np_img, xs, ys, (tw, th), selected,
+                                          ["0" + str(r + 1) + "_0" + str(c + 1) for r, c in grid],
+                                          scale=self.ann_scale)
+                  ann.save(fp=os.path.join(self.__np, "annotation.jpg"))
+
+          # Table
+          self.__tab_out["Name"] = tile_name
+          self.__tab_out["score"] = s_score
+          self.__tab_out["color_factor"] = s_color_factor
+          self.__tab_out["s_and_v_factor"] = s_s_and_v_factor
+          self.__tab_out["quantity_factor"] = s_quantity_factor
+          self.__tab_out["source"] = self.__np
+
+          self.__tab_out.to_csv(os.path.join(self.__np, "annotation.csv"), index=False)
+
+      writer.report()
       return
 
+  def __name(self, r, c):
+      """
+      File name of the tile in row r and column c (0 based), as image_slicer named them.
+      """
+      return "{}_slice_{:02d}_{:02d}.jpg".format(self.__bn, r + 1, c + 1)
+
+  def __writer(self, root):
+      """
+      Get the tile writer for the output mode.
 
+      Args:
+          root: Folder the tiles go to.
+      """
+      if self.out == "tar":
+          return ShardWriter(root, prefix=self.__bn + "_slice", threads=self.threads)
+      return TileWriter(threads=self.threads)
 
   def fit(self):
       """
@@ -161,33 +293,60 @@ class Tile:
       return
 
 
-def multi_image_to_tile(path, sf=".png", threshold=80, sa=False):
+def multi_image_to_tile(path, sf=".png", threshold=80, sa=False, resume=True, threads=4,
+                        out="jpeg", metrics=None, profile=False, memory=False, size=None, stride=None,
+                        ann_scale=0.25):
     """
     Apply a set of filters to image folder
+    Progress is journaled in tiles/manifest.jsonl, a rerun skips the images
+    already tiled with the same parameters and redoes changed or partial ones.
 
     Args:
         path: Image folder
         sf: The file format of the images
         threshold: The percentage tissue quantity to retain
         sa: Save all tiles
+        resume: Skip the images the manifest marks as done
+        threads: Number of threads encoding and writing tiles
+        out: Tile output, "jpeg" files or "tar" shards
+        metrics: JSON file for the per-stage timers and counters, also rewritten during the run
+        profile: Save a cProfile of every image next to the metrics file
+        memory: Record the peak traced memory of every image
+        size: Tile size in pixels, None for about 10 tiles per 1041 pixels along each side
+        stride: Distance between tiles in pixels, size by default, smaller for overlapping tiles
+        ann_scale: Size of the annotation images relative to the images, 0 or None skips them
 
     """
-    timer = Time()
+    timer = mt.start(metrics, profile=profile, memory=memory)
 
-    files = os.listdir(path)
-    new_path = os.path.join(path, "tiles")
+    files = [i for i in os.listdir(path) if i.endswith(sf)]
+    new_path = os.path.abspath(os.path.join(path, "tiles"))
 
     if not os.path.isdir(new_path):
         os.mkdir(new_path)
-        os.chdir(os.path.join(os.getcwd(), new_path))
+
+    manifest = Manifest(new_path, dict(sf=sf, threshold=threshold, sa=sa, out=out, size=size, stride=stride,
+                                       ann_scale=ann_scale))
+    if resume:
+        files = [i for i in files if not manifest.done(os.path.join(path, i))]
 
     print("Processing {} images".format(len(files)))
 
     for i in files:
-        if i.endswith(sf):
-            sl = str(os.path.join(path, i))
-            img = Tile(x=sl, o=os.getcwd(), t=threshold, sa=sa)
-            img.fit()
+        sl = str(os.path.join(path, i))
+        img = Tile(x=sl, o=new_path, t=threshold, sa=sa, threads=threads, out=out, size=size, stride=stride,
+                   ann_scale=ann_scale)
+        manifest.start(sl, [os.path.join(new_path, os.path.basename(sl[:-4]))])
+
+        try:
+            with timer.input(sl):
+                img.fit()
+            manifest.finish(sl)
+
+        except Exception as err:
+            print("ERROR: {} failed with {}".format(i, repr(err)))
+            manifest.finish(sl, repr(err))
+
     timer.elapsed_display()
     return path
 
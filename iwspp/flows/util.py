@@ -4,8 +4,7 @@ import sys
 import numpy as np
 from PIL import Image
 import cv2 as cv
-import spams
-import matplotlib.pyplot as plt
+from iwspp.flows import metrics as mt
 
 ADDITIONAL_NP_STATS = False
 
@@ -113,6 +112,8 @@ def show_colors(c):
     :param c:
     :return:
     """
+    import matplotlib.pyplot as plt
+
     n = c.shape[0]
     for i in range(n):
         if c[i].max() > 1.0:
@@ -133,6 +134,8 @@ def show(image, now=True, fig_size=(10, 10)):
     :param fig_size:
     :return:
     """
+    import matplotlib.pyplot as plt
+
     image = image.astype(np.float32)
     m, mm = image.min(), image.max()
 
@@ -178,6 +181,7 @@ def patch_grid(ims, width=5, sub_sample=None, rand=False, save_name=None):
         rand: Should the output be random
         save_name: The name to save it
     """
+    import matplotlib.pyplot as plt
 
     n0 = np.shape(ims)[0]
 
@@ -243,6 +247,10 @@ def remove_zeros(x):
     return x
 
 
+# Optical density of every uint8 value, zeros count as ones as in remove_zeros()
+OD_LUT = (-np.log(np.maximum(np.arange(256), 1) / 255.0)).astype(np.float32)
+
+
 def convert_rgb_od(x, t="od"):
     """
     Inter-convert between RGB and optical density
@@ -263,6 +271,100 @@ def convert_rgb_od(x, t="od"):
     return out
 
 
+# Most pixels used to estimate a stain matrix, and candidates drawn per kept pixel
+STAIN_PIXELS = 2 ** 18
+STAIN_OVERSAMPLE = 4
+
+
+def stain_sample(x, keep, n=STAIN_PIXELS, seed=0, chunk=2 ** 18):
+    """
+    Seeded, bounded sample of the tissue pixels of an image in optical density,
+    with the covariance of the tissue pixels accumulated chunk by chunk.
+    Large images are first reduced to n * STAIN_OVERSAMPLE random candidate
+    pixels, so time and memory do not grow with the image size. The full optical
+    density array is never built.
+
+    Args:
+        x: RGB image, or any (..., 3) array of pixels in 0-255. uint8 pixels are
+           converted with OD_LUT, others with convert_rgb_od() on a copy of each chunk.
+        keep: Function of (optical densities, RGB pixels) of a chunk returning the
+              boolean mask of its tissue pixels.
+        n: Largest number of pixels in the sample.
+        seed: Seed of the sample.
+        chunk: Pixels converted at a time.
+    Returns:
+        Tuple of the 3x3 covariance of the tissue candidates (None without tissue)
+        and an (m, 3) float32 sample of their optical densities, m <= n.
+    """
+    rs = np.random.RandomState(seed)
+    px = np.asarray(x).reshape((-1, 3))
+    if px.shape[0] > n * STAIN_OVERSAMPLE:
+        # Drawn with replacement, a permutation of every pixel would cost as much as the image
+        px = px[np.sort(rs.randint(0, px.shape[0], n * STAIN_OVERSAMPLE))]
+
+    count, total, outer = 0, np.zeros(3), np.zeros((3, 3))
+    sample, keys = np.zeros((0, 3), dtype=np.float32), np.zeros(0)
+
+    for k in range(0, px.shape[0], chunk):
+        rgb = px[k:k + chunk]
+        if rgb.dtype == np.uint8:
+            od = OD_LUT[rgb]
+        else:
+            od = convert_rgb_od(np.array(rgb, dtype=np.float64)).astype(np.float32)
+        od = od[keep(od, rgb)]
+        if not len(od):
+            continue
+
+        # Streaming sums for the covariance
+        od64 = od.astype(np.float64)
+        count += od.shape[0]
+        total += od64.sum(axis=0)
+        outer += od64.T @ od64
+
+        # Keep the n pixels with the smallest random keys, a uniform sample of the tissue
+        sample = np.concatenate([sample, od])
+        keys = np.concatenate([keys, rs.random_sample(od.shape[0])])
+        if sample.shape[0] > n:
+            best = np.argpartition(keys, n)[:n]
+            sample, keys = sample[best], keys[best]
+
+    if count < 2:
+        return None, sample
+
+    mean = total / count
+    cov = (outer - count * np.outer(mean, mean)) / (count - 1)
+    return cov, sample
+
+
+def save_normalizer(path, kind, **state):
+    """
+    Save the fitted state of a normalizer to a small .npz file.
+
+    Args:
+        path: File to write.
+        kind: Name of the normalizer, checked when loading.
+        state: Arrays and strings of the fitted state.
+    """
+    np.savez(path, kind=kind, **state)
+    return
+
+
+def load_normalizer(path, kind):
+    """
+    Read the state saved by save_normalizer().
+
+    Args:
+        path: File to read.
+        kind: Name of the normalizer expected in the file.
+    Returns:
+        Dictionary of the saved state.
+    """
+    with np.load(path) as f:
+        if str(f["kind"]) != kind:
+            raise ValueError("{} holds a {} normalizer, not {}".format(path, f["kind"], kind))
+        return {k: f[k] for k in f.files if k != "kind"}
+
+
 def normalize_rows(x):
     """
     Normalize rows of an array
@@ -300,7 +402,63 @@ def sign(x):
         return 0
 
 
-def get_concentrations(x, stain_matrix, lamda=0.01):
+# Relative determinant of the stain Gram matrix below which the two stains count as collinear
+COLLINEAR_EPS = 1e-6
+
+
+def solve_concentrations(od, stain_matrix, lamda=0.01):
+    """
+    Exact two-stain solution of min 0.5 * |od - c S|^2 + lamda * sum(c), c >= 0
+    for every pixel, the problem spams.lasso(mode=2, pos=True) solves.
+    The problem is convex with two variables, so the solution is the one of the
+    four active sets (both, first, second or no stain) meeting its KKT conditions.
+    With collinear or zero stains the both-stains system is singular, only the
+    best single-stain solution is used then.
+
+    Args:
+        od: Optical densities (npix x 3)
+        stain_matrix: a 2x3 stain matrix
+        lamda: Factor
+    Returns:
+        Concentrations (npix x 2), float32
+    """
+    s = np.asarray(stain_matrix, dtype=np.float64)
+    g = s @ s.T
+    det = g[0, 0] * g[1, 1] - g[0, 1] ** 2
+    singular = det <= COLLINEAR_EPS * g[0, 0] * g[1, 1]
+    det = np.float32(det)
+    g = g.astype(np.float32)
+    b = od @ s.T.astype(np.float32) - np.float32(lamda)
+    b0, b1 = b[:, 0], b[:, 1]
+
+    # One stain alone, a zero stain has b = -lamda < 0 and is never active
+    tiny = np.finfo(np.float32).tiny
+    a0 = b0 / max(g[0, 0], tiny)
+    a1 = b1 / max(g[1, 1], tiny)
+
+    if singular:
+        # Collinear stains: the best single stain, it lowers the objective by b * a / 2
+        both = np.zeros(od.shape[0], dtype=bool)
+        c0 = c1 = a0
+        first = (a0 > 0) & ((a1 <= 0) | (b0 * a0 >= b1 * a1))
+        second = ~first & (a1 > 0)
+    else:
+        # Both stains present: G c = b
+        c0 = (g[1, 1] * b0 - g[0, 1] * b1) / det
+        c1 = (g[0, 0] * b1 - g[0, 1] * b0) / det
+        both = (c0 > 0) & (c1 > 0)
+
+        # One stain, the gradient of the other must not push it above zero
+        first = ~both & (a0 > 0) & (b1 - g[0, 1] * a0 <= 0)
+        second = ~both & ~first & (a1 > 0) & (b0 - g[0, 1] * a1 <= 0)
+
+    out = np.zeros((od.shape[0], 2), dtype=np.float32)
+    out[:, 0] = np.where(both, c0, np.where(first, a0, 0))
+    out[:, 1] = np.where(both, c1, np.where(second, a1, 0))
+    return out
+
+
+def get_concentrations(x, stain_matrix, lamda=0.01, method="active_set"):
     """
     Get concentrations, a npix x 2 matrix
 
@@ -308,7 +466,23 @@ def get_concentrations(x, stain_matrix, lamda=0.01):
         x: Image to convert
         stain_matrix: a 2x3 stain matrix
         lamda: Factor
+        method: "active_set" for the exact NumPy solver (solve_concentrations),
+                "spams" for spams.lasso
     """
+    if method == "active_set":
+        if x.dtype == np.uint8:
+            od = OD_LUT[x.reshape((-1, 3))]
+        else:
+            od = convert_rgb_od(x, t="od").reshape((-1, 3)).astype(np.float32)
+        with mt.get().stage("lasso"):
+            return solve_concentrations(od, stain_matrix, lamda)
+
+    if method != "spams":
+        raise ValueError("method must be one of active_set or spams, not {}".format(method))
+
+    import spams
+
     od = convert_rgb_od(x, t="od").reshape((-1, 3))
-    return spams.lasso(od.T, D=stain_matrix.T, mode=2, lambda1=lamda, pos=True).toarray().T
+    with mt.get().stage("lasso"):
+        return spams.lasso(od.T, D=stain_matrix.T, mode=2, lambda1=lamda, pos=True).toarray().T
 
@@ -0,0 +1,151 @@
+"""
+Name: writer
+Author: Chinedu A. Anene, Phd
+"""
+
+import os
+import io
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from iwspp.flows import metrics as mt
+
+
+class TileWriter:
+    """
+    Encode and write tiles on a thread pool while the caller keeps extracting.
+    At most queue tiles wait to be written, submit() blocks beyond that.
+    """
+
+    def __init__(self, threads=4, queue=64, fmt="JPEG"):
+        """
+        TileWriter class.
+
+        Parameters:
+            threads: Number of encoding and writing threads.
+            queue: Maximum number of tiles waiting to be written.
+            fmt: PIL format to encode the tiles with.
+        """
+        self.fmt = fmt
+        self.tiles = 0
+        self.bytes = 0
+        self.__pool = ThreadPoolExecutor(max_workers=threads)
+        self.__slots = threading.BoundedSemaphore(queue)
+        self.__lock = threading.Lock()
+        self.__dirs = set()
+        self.__error = None
+        self.__closed = False
+        self.__start = time.time()
+
+    def __str__(self):
+        return "Tile writer, {} tiles written.".format(self.tiles)
+
+    def __repr__(self):
+        return "\n" + self.__str__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Flush what was queued but keep the original exception
+            self.__pool.shutdown(wait=True)
+            self.__closed = True
+        return False
+
+    def __raise(self):
+        if self.__error is not None:
+            err, self.__error = self.__error, None
+            raise err
+
+    def mkdirs(self, paths):
+        """
+        Create the folders for a batch of tiles, each folder is created once.
+
+        Args:
+            paths: Folders to create.
+        """
+        for p in set(paths) - self.__dirs:
+            if p and not os.path.exists(p):
+                os.makedirs(p, exist_ok=True)
+            self.__dirs.add(p)
+        return
+
+    def submit(self, img, path, meta=None):
+        """
+        Queue a tile for writing, blocks while the queue is full.
+        Raises the error of a failed earlier write.
+
+        Args:
+            img: Tile as a PIL image or an RGB NumPy array.
+            path: File to write the tile to.
+            meta: Tile metadata, only kept by writers with an index (see shard.ShardWriter).
+        """
+        self.__raise()
+        self.mkdirs([os.path.dirname(path)])
+        self.__slots.acquire()
+        self.__pool.submit(self.__write, img, path)
+        return
+
+    def __write(self, img, path):
+        m = mt.get()
+        try:
+            with m.stage("encode"):
+                if isinstance(img, np.ndarray):
+                    img = Image.fromarray(img)
+                buf = io.BytesIO()
+                img.save(buf, self.fmt)
+                data = buf.getvalue()
+
+            with m.stage("write"):
+                self._put(path, data)
+
+            with self.__lock:
+                self.tiles += 1
+                self.bytes += len(data)
+            m.count("tiles_written")
+            m.count("bytes_written", len(data))
+
+        except Exception as err:
+            with self.__lock:
+                if self.__error is None:
+                    self.__error = err
+
+        finally:
+            self.__slots.release()
+        return
+
+    def _put(self, path, data):
+        """
+        Store one encoded tile.
+
+        Args:
+            path: File to write the tile to.
+            data: Encoded tile.
+        """
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return
+
+    def close(self):
+        """
+        Wait for every queued tile, then raise the first write error if any.
+        """
+        if not self.__closed:
+            self.__pool.shutdown(wait=True)
+            self.__closed = True
+        self.__raise()
+        return
+
+    def report(self):
+        """
+        Display the number of tiles written and the write throughput.
+        """
+        elapsed = max(time.time() - self.__start, 1e-9)
+        print("Wrote {} tiles, {:.1f} MB in {:.1f} s ({:.1f} tiles/s, {:.1f} MB/s)".format(
+            self.tiles, self.bytes / 1e6, elapsed, self.tiles / elapsed, self.bytes / 1e6 / elapsed))
+        return
@@ -0,0 +1,18 @@
+import numpy as np
+from iwspp.flows import segment
+
+
+def block(color, size=32):
+  rgba = np.full((size, size, 4), 255, dtype=np.uint8)
+  rgba[..., :3] = color
+  return rgba
+
+
+def test_bluish_hematoxylin_is_tissue():
+  for color in [(70, 80, 160), (40, 40, 120), (150, 80, 170), (230, 140, 190)]:
+    assert segment.tissue_block(block(color), 0.1, radius=0, min_area=0).all(), color
+
+
+def test_pen_marks_are_rejected():
+  for color in [(30, 60, 180), (20, 40, 140), (40, 150, 80), (60, 160, 170)]:
+    assert not segment.tissue_block(block(color), 0.1, radius=0, min_area=0).any(), color
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from iwspp.flows import slide
+
+
+def candidates(cols, rows, seed=0):
+  """
+  One scored tile per grid cell of the left quarter of the level, the rest is glass.
+  """
+  rs = np.random.RandomState(seed)
+  tiles = []
+  for c in range(cols):
+    for r in range(rows):
+      img = np.zeros((1, 1, 3), dtype=np.uint8) if c < cols // 4 else None
+      tiles.append(((c, r), (c, r, 90, img, (rs.random_sample(),))))
+  return tiles
+
+
+def test_best_tiles_top():
+  tiles = candidates(20, 20)
+  kept = slide.best_tiles(tiles, 30)
+  scores = sorted((t[1][4][0] for t in tiles if t[1][3] is not None), reverse=True)
+  assert sorted((k[1][4][0] for k in kept), reverse=True) == scores[:30]
+
+
+def test_best_tiles_stratified_fills_empty_strata():
+  tiles = candidates(20, 20)
+  kept = slide.best_tiles(tiles, 30, grid=(20, 20))
+  assert len(kept) == 30
+  assert len(set(k[0] for k in kept)) == 30
+
+  few = slide.best_tiles(tiles[:40], 60, grid=(20, 20))
+  assert len(few) == sum(t[1][3] is not None for t in tiles[:40])
+
+
+def test_fit_rejects_unknown_select():
+  with pytest.raises(ValueError):
+    slide.Slide("missing.svs").fit(select="best")
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from iwspp.flows import stain
+
+
+def he_tiles(n=8, size=64, seed=0):
+  """
+  Random tiles of purple and pink pixels on a light background.
+  """
+  rs = np.random.RandomState(seed)
+  base = np.array([[150, 80, 170], [230, 140, 190], [235, 230, 235]], dtype=np.int32)
+  pick = rs.randint(0, 3, (n, size, size))
+  noise = rs.randint(-25, 26, (n, size, size, 3))
+  return np.clip(base[pick] + noise, 0, 255).astype(np.uint8)
+
+
+def edge_tiles(size=32, seed=0):
+  """
+  Tiles the fast hue path could get wrong: all gray, channels tied for the
+  maximum, and no hue at all between 260 and 340 degrees.
+  """
+  rs = np.random.RandomState(seed)
+  low = rs.randint(0, 200, (size, size)).astype(np.uint8)
+  high = np.full((size, size), 220, dtype=np.uint8)
+
+  gray = np.repeat(rs.randint(0, 256, (size, size, 1)), 3, axis=2).astype(np.uint8)
+  red_blue = np.stack([high, low, high], axis=-1)
+  red_green = np.stack([high, high, low], axis=-1)
+  green_blue = np.stack([low, high, high], axis=-1)
+  green = np.stack([low // 2, high, low // 2], axis=-1)
+  return np.stack([np.full((size, size, 3), 128, dtype=np.uint8), gray, red_blue, red_green, green_blue, green])
+
+
+def assert_reference(stack, tissue_percents):
+  new = stain.score_tiles(stack, tissue_percents)
+  ref = np.array([stain.score_tile_reference(stack[k], tissue_percents[k]) for k in range(len(stack))]).T
+
+  assert np.abs(new[0] - ref[0]).max() <= stain.SCORE_TOLERANCE
+  assert np.array_equal(new[2], ref[2])
+  assert np.array_equal(new[3], ref[3])
+
+
+def test_score_tiles_matches_reference():
+  stack = he_tiles()
+  assert_reference(stack, np.linspace(5, 100, len(stack)))
+
+
+@pytest.mark.parametrize("tissue_percent", [0, 50, 90])
+def test_score_tiles_matches_reference_on_edge_tiles(tissue_percent):
+  stack = edge_tiles()
+  assert_reference(stack, np.full(len(stack), tissue_percent, dtype=np.float64))
+
+
+def test_score_tile_matches_score_tiles():
+  stack = he_tiles(n=3)
+  scores = stain.score_tiles(stack, [20, 60, 95])
+  for k, tp in enumerate([20, 60, 95]):
+    assert np.allclose(stain.score_tile(stack[k], tp), [x[k] for x in scores])
+
+
+def test_tile_hsv_matches_rgb_to_hues():
+  stack = np.concatenate([he_tiles(n=2, size=32), edge_tiles()])
+  for tile in stack:
+    hues, _, _ = stain.tile_hsv(tile)
+    ref = stain.rgb_to_hues(tile).reshape(hues.shape)
+    # The float64 reference can land one degree lower on exact whole degrees
+    assert np.isin(hues.astype(np.int64) - ref.astype(np.int64), [0, 1, -359]).all()
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from iwspp.flows import util
+from iwspp.Normalize import Macenko
+
+# Largest concentration difference to spams.lasso, as CONCENTRATION_TOLERANCE in benchmarks/bench.py
+CONCENTRATION_TOLERANCE = 1e-4
+
+
+def he_image(size=256, seed=0):
+  """
+  Random purple and pink pixels on glass, with some pure white and black ones.
+  """
+  rs = np.random.RandomState(seed)
+  base = np.array([[150, 80, 170], [230, 140, 190], [240, 238, 242], [255, 255, 255], [0, 0, 0]],
+                  dtype=np.int32)
+  pick = rs.choice(5, (size, size), p=[0.35, 0.35, 0.26, 0.02, 0.02])
+  noise = rs.randint(-30, 31, (size, size, 3))
+  return np.clip(base[pick] + noise * (pick[..., None] < 3), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_active_set_matches_spams(seed):
+  pytest.importorskip("spams")
+  img = util.standardize_brightness(he_image(seed=seed))
+  stains = Macenko.get_stain_matrix(img.copy())
+
+  ref = util.get_concentrations(img.copy(), stains, method="spams")
+  new = util.get_concentrations(img.copy(), stains, method="active_set")
+  assert new.shape == ref.shape
+  assert np.abs(new - ref).max() <= CONCENTRATION_TOLERANCE
+
+
+def test_active_set_float_input():
+  img = util.standardize_brightness(he_image())
+  stains = Macenko.get_stain_matrix(img.copy())
+
+  new = util.get_concentrations(img, stains)
+  flt = util.get_concentrations(img.astype(np.float64), stains)
+  assert np.abs(new - flt).max() <= CONCENTRATION_TOLERANCE
+
+
+def test_active_set_unknown_method():
+  with pytest.raises(ValueError):
+    util.get_concentrations(he_image(size=8), np.eye(2, 3), method="lars")
+
+
+def objective(od, c, stains, lamda=0.01):
+  return 0.5 * ((od - c @ stains) ** 2).sum(axis=1) + lamda * c.sum(axis=1)
+
+
+@pytest.mark.parametrize("stains", [
+  [[0.65, 0.70, 0.29], [0.65, 0.70, 0.29]],
+  [[0.65, 0.70, 0.29], [1.30, 1.40, 0.58]],
+  [[0.65, 0.70, 0.29], [0.0, 0.0, 0.0]],
+  [[0.79504903, 0.57695220, 0.18714487], [0.79504909, 0.57695220, 0.18714488]],
+])
+def test_active_set_collinear_stains(stains):
+  stains = np.array(stains)
+  img = he_image(size=64)
+  od = util.OD_LUT[img.reshape((-1, 3))]
+
+  new = util.solve_concentrations(od, stains)
+  assert np.isfinite(new).all() and (new >= 0).all()
+
+  # Any point of the both-stains line is as good, the objective must still be the optimum
+  spams = pytest.importorskip("spams")
+  ref = spams.lasso(np.asfortranarray(od.T.astype(np.float64)), D=np.asfortranarray(stains.T),
+                    mode=2, lambda1=0.01, pos=True).toarray().T
+  assert (objective(od, new, stains) - objective(od, ref, stains)).max() <= CONCENTRATION_TOLERANCE
+
+
+def test_stain_matrix_of_blank_tile():
+  with pytest.raises(ValueError, match="no tissue pixels"):
+    Macenko.get_stain_matrix(np.full((32, 32, 3), 255, dtype=np.uint8))